@@ -1,11 +1,15 @@
 # [backend/main.py] - Versión Completa con Emails + Limpieza Automática + Fixes Usuarios
 
 import socketio
-from fastapi import FastAPI, HTTPException, Depends, status, Request, Header, BackgroundTasks
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey, MetaData, Table, text, DateTime, func, PrimaryKeyConstraint
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Header, Response, Query
+from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey, MetaData, Table, text, DateTime, func, PrimaryKeyConstraint, insert, cast, select, Index, tuple_
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Session, joinedload
 from sqlalchemy.exc import OperationalError, IntegrityError 
-from pydantic import BaseModel, EmailStr
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.engine import make_url
+from sqlalchemy import event
+from pydantic import BaseModel, EmailStr, ValidationError
 from typing import List, Optional, Annotated
 from fastapi.middleware.cors import CORSMiddleware
 import datetime
@@ -19,10 +23,27 @@ from fastapi.responses import RedirectResponse
 import os
 import csv
 import io
+import asyncio
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+import traceback
+import base64
+import json
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from fastapi.responses import StreamingResponse
 # --- LIBRERÍAS NUEVAS (Email y Scheduler) ---
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
+import aiosmtplib
+from email.message import EmailMessage
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+# --- Métricas (formato Prometheus) ---
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.registry import Collector
 from fastapi import Body
 
 # --- 1. Configuración de Base de Datos ---
@@ -32,6 +53,26 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
 
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Motor async (asyncpg) para los endpoints `async def` del camino caliente: sus round trips
+# ceden el event loop en lugar de bloquearlo. El resto de la app sigue con el motor sync.
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", "10"))
+DB_ASYNC_MAX_OVERFLOW = int(os.getenv("DB_ASYNC_MAX_OVERFLOW", "20"))
+DB_ASYNC_POOL_TIMEOUT = int(os.getenv("DB_ASYNC_POOL_TIMEOUT", "30"))
+
+def _url_async(url: str):
+    # asyncpg no entiende `sslmode` en la URL: se pasa como argumento `ssl`
+    u = make_url(url).set(drivername="postgresql+asyncpg")
+    query = dict(u.query)
+    sslmode = query.pop("sslmode", None)
+    return u.set(query=query), ({"ssl": sslmode} if sslmode and sslmode != "disable" else {})
+
+_url_asyncpg, _args_asyncpg = _url_async(DATABASE_URL)
+async_engine = create_async_engine(
+    _url_asyncpg, connect_args=_args_asyncpg, pool_pre_ping=True,
+    pool_size=DB_ASYNC_POOL_SIZE, max_overflow=DB_ASYNC_MAX_OVERFLOW, pool_timeout=DB_ASYNC_POOL_TIMEOUT
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # --- 2. Seguridad ---
@@ -41,6 +82,66 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/token")
 API_KEY_SECRET = "una-clave-secreta-larga-para-los-nodos-12345"
+# Solo para firmware viejo que no manda la clave: /api/telemetria y 'dato_sensor' sin X-API-Key (inseguro)
+TELEMETRIA_SIN_CLAVE = os.getenv("TELEMETRIA_SIN_CLAVE", "false").lower() == "true"
+MAX_LOTE_LECTURAS = int(os.getenv("MAX_LOTE_LECTURAS", "1000")) # Máximo de lecturas por POST /api/lectura/batch
+PRINCIPAL_TTL_SEG = int(os.getenv("PRINCIPAL_TTL_SEG", "30"))     # Vida del usuario autenticado en caché (0 = sin caché)
+PRINCIPAL_MAX = int(os.getenv("PRINCIPAL_MAX", "1000"))           # Usuarios distintos en caché (LRU)
+BCRYPT_HILOS = int(os.getenv("BCRYPT_HILOS", "2"))                # Hilos dedicados a hashear/verificar contraseñas
+BCRYPT_MAX_PENDIENTES = int(os.getenv("BCRYPT_MAX_PENDIENTES", "64")) # Tope de operaciones en espera (después: 503)
+
+# --- Ingesta asíncrona (write-behind): las lecturas se encolan y se confirman con 202 ---
+INGESTA_ASINCRONA = os.getenv("INGESTA_ASINCRONA", "false").lower() == "true"
+BUFFER_MAX_FILAS = int(os.getenv("BUFFER_MAX_FILAS", "20000"))   # Tope de la cola en memoria
+BUFFER_FLUSH_FILAS = int(os.getenv("BUFFER_FLUSH_FILAS", "500")) # Volcar al juntar N filas...
+BUFFER_FLUSH_MS = int(os.getenv("BUFFER_FLUSH_MS", "250"))       # ...o cada M milisegundos
+BUFFER_REINTENTOS = int(os.getenv("BUFFER_REINTENTOS", "3"))     # Volcados fallidos antes de aislar las filas malas
+BUFFER_CIERRE_SEG = float(os.getenv("BUFFER_CIERRE_SEG", "15"))  # Tiempo máximo del volcado final al apagar
+
+# --- Métricas y logs ---
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Si está definido, /metrics exige "Authorization: Bearer <token>"
+SOCKETIO_LOGS = os.getenv("SOCKETIO_LOGS", "false").lower() == "true" # Log de cada paquete de Socket.IO (solo para depurar)
+
+# --- Perfil SQL por request (opcional, para depurar) ---
+PERFIL_SQL = os.getenv("PERFIL_SQL", "false").lower() == "true"
+PERFIL_SQL_HISTORIAL = int(os.getenv("PERFIL_SQL_HISTORIAL", "500")) # Requests guardados para el endpoint de admin
+PERFIL_SQL_LENTAS = int(os.getenv("PERFIL_SQL_LENTAS", "5"))         # Sentencias más lentas guardadas por request
+PERFIL_SQL_REPETIDAS = int(os.getenv("PERFIL_SQL_REPETIDAS", "10"))  # Misma sentencia N veces en un request = posible N+1
+PERFIL_SQL_STACKS = os.getenv("PERFIL_SQL_STACKS", "false").lower() == "true" # Guardar desde dónde (en Python) salen las sentencias de requests lentos
+PERFIL_SQL_LENTO_MS = float(os.getenv("PERFIL_SQL_LENTO_MS", "500"))   # Request lento: desde acá se muestrean stacks
+
+# --- Captura de tráfico de ingesta (opcional, para reproducirlo con reproducir_captura.py) ---
+CAPTURA_INGESTA = os.getenv("CAPTURA_INGESTA", "false").lower() == "true"
+CAPTURA_DIR = os.getenv("CAPTURA_DIR", "capturas")                  # Un archivo por proceso: ingesta-<pid>.jsonl
+CAPTURA_MAX_MB = int(os.getenv("CAPTURA_MAX_MB", "50"))             # Rotar al superar este tamaño...
+CAPTURA_ARCHIVOS = int(os.getenv("CAPTURA_ARCHIVOS", "10"))         # ...conservando N archivos viejos (.1, .2, ...)
+CAPTURA_MAX_COLA = int(os.getenv("CAPTURA_MAX_COLA", "20000"))      # Registros pendientes de escribir (después se descartan)
+
+# --- Difusión al dashboard ---
+DIFUSION_MS = int(os.getenv("DIFUSION_MS", "250")) # Cada cuánto sale el frame agrupado por sala de Socket.IO
+SYNC_HISTORIAL_FRAMES = int(os.getenv("SYNC_HISTORIAL_FRAMES", "240")) # Frames guardados para resincronizar por delta (~1 min)
+
+# --- Despachador de emails ---
+EMAIL_CONEXIONES = int(os.getenv("EMAIL_CONEXIONES", "2"))      # Conexiones SMTP persistentes (una por worker de envío)
+EMAIL_MAX_COLA = int(os.getenv("EMAIL_MAX_COLA", "1000"))       # Tope de la cola de salida
+EMAIL_MAX_POR_HORA = int(os.getenv("EMAIL_MAX_POR_HORA", "30")) # Emails de alarma por destinatario por hora
+EMAIL_MAX_TRANSACCIONALES_POR_HORA = int(os.getenv("EMAIL_MAX_TRANSACCIONALES_POR_HORA", "10")) # Aparte (recuperación de contraseña, ...)
+EMAIL_DIGEST_SEG = int(os.getenv("EMAIL_DIGEST_SEG", "30"))     # Ventana para agrupar alertas (0 = sin agrupar)
+EMAIL_REINTENTOS = int(os.getenv("EMAIL_REINTENTOS", "4"))      # Reintentos con backoff exponencial
+
+# --- TimescaleDB: `lecturas` como hypertable (si la extensión está disponible) ---
+EXPORT_FILAS_POR_TANDA = int(os.getenv("EXPORT_FILAS_POR_TANDA", "50000")) # Record batch de /api/exportar/lecturas
+MUESTREO_FACTOR = int(os.getenv("MUESTREO_FACTOR", "10"))           # Filas leídas por punto pedido antes de reducir un gráfico...
+MAX_FILAS_MUESTREO = int(os.getenv("MAX_FILAS_MUESTREO", "200000")) # ...con este tope absoluto por request
+
+# --- Motor de alarmas ---
+ALARMA_HISTERESIS_PCT = float(os.getenv("ALARMA_HISTERESIS_PCT", "2"))  # Margen para normalizar (% del rango de límites)
+ALARMA_DEMORA_SEG = int(os.getenv("ALARMA_DEMORA_SEG", "0"))            # Segundos fuera de rango antes de disparar
+
+LECTURAS_CHUNK_HORAS = int(os.getenv("LECTURAS_CHUNK_HORAS", "24"))         # Tamaño de cada chunk
+LECTURAS_COMPRIMIR_DIAS = int(os.getenv("LECTURAS_COMPRIMIR_DIAS", "7"))    # Comprimir chunks más viejos que N días
+TIMESCALE_ACTIVO = False # Se define en el arranque (configurar_timescale)
+MIGRACION_VENTANA_HORAS = int(os.getenv("MIGRACION_VENTANA_HORAS", "24"))   # Historial por transacción en los rellenos únicos
 
 # --- 3. Modelos de Datos (Tablas) ---
 class Nodo(Base):
@@ -75,6 +176,42 @@ class Lectura(Base):
     sensor = relationship("Sensor", back_populates="lecturas")
     __table_args__ = (PrimaryKeyConstraint('id', 'ts'),)
 
+class UltimaLectura(Base):
+    # Última lectura de cada sensor (upsert en la ingesta): el estado actual no escanea `lecturas`
+    __tablename__ = "ultima_lectura"
+    id_sensor = Column(String, ForeignKey("sensores.id", ondelete="CASCADE"), primary_key=True)
+    ts = Column(DateTime(timezone=True))
+    valor = Column(Float)
+
+# Rollups (agregados por sensor y bucket) para gráficos de rangos largos; se mantienen en la ingesta
+class Lectura1m(Base):
+    __tablename__ = "lecturas_1m"
+    id_sensor = Column(String, ForeignKey("sensores.id", ondelete="CASCADE"), primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    suma = Column(Float)
+    cantidad = Column(Integer)
+
+class Lectura1h(Base):
+    __tablename__ = "lecturas_1h"
+    id_sensor = Column(String, ForeignKey("sensores.id", ondelete="CASCADE"), primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    minimo = Column(Float)
+    maximo = Column(Float)
+    suma = Column(Float)
+    cantidad = Column(Integer)
+
+ROLLUPS = [(Lectura1m, 60), (Lectura1h, 3600)] # (modelo, segundos por bucket), de más fino a más grueso
+
+class EstadoAlarma(Base):
+    # Checkpoint del motor de alarmas: solo se escribe en cada transición
+    __tablename__ = "estado_alarma"
+    id_sensor = Column(String, ForeignKey("sensores.id", ondelete="CASCADE"), primary_key=True)
+    estado = Column(String, default="NORMAL") # NORMAL, ALTA, BAJA
+    desde = Column(DateTime(timezone=True))
+    ultima_notificacion = Column(DateTime(timezone=True))
+
 class Suscripcion(Base):
     __tablename__ = "suscripciones"
     id = Column(Integer, primary_key=True, index=True)
@@ -95,6 +232,14 @@ class Usuario(Base):
     eventos = relationship("Evento", back_populates="usuario_obj")
     suscripciones = relationship("Suscripcion", back_populates="usuario", cascade="all, delete-orphan")
 
+# Grupos de tipo_evento que usan los logs, la exportación y la limpieza
+TIPOS_ACCESO = ["LOGIN_EXITOSO", "LOGIN_FALLIDO"]
+TIPOS_ALARMA = ["ALARMA_ALTA", "ALARMA_BAJA", "ALARMA_NORMALIZADA"]
+TIPOS_CONEXION = ["DESCONECTADO", "RECONECTADO"]
+TIPOS_NO_AUDITORIA = TIPOS_ACCESO + TIPOS_ALARMA + TIPOS_CONEXION
+
+def _sql_tipos(tipos): return ", ".join(f"'{t}'" for t in tipos)
+
 class Evento(Base):
     __tablename__ = "eventos"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -105,6 +250,17 @@ class Evento(Base):
     detalle = Column(String) 
     usuario_obj = relationship("Usuario", back_populates="eventos")
     sensor_obj = relationship("Sensor", back_populates="eventos")
+    __table_args__ = (
+        # Índices parciales por pestaña de logs: el predicado coincide con el filtro del endpoint
+        # y (ts, id) con el orden/cursor de la paginación por keyset
+        Index("ix_eventos_accesos_ts_id", "ts", "id", postgresql_where=text(f"tipo_evento IN ({_sql_tipos(TIPOS_ACCESO)})")),
+        Index("ix_eventos_alarmas_ts_id", "ts", "id", postgresql_where=text(f"tipo_evento IN ({_sql_tipos(TIPOS_ALARMA)})")),
+        Index("ix_eventos_conexiones_ts_id", "ts", "id", postgresql_where=text(f"tipo_evento IN ({_sql_tipos(TIPOS_CONEXION)})")),
+        Index("ix_eventos_auditoria_ts_id", "ts", "id", postgresql_where=text(f"tipo_evento NOT IN ({_sql_tipos(TIPOS_NO_AUDITORIA)})")),
+        # Filtros por sensor / usuario
+        Index("ix_eventos_sensor_ts_id", "id_sensor", "ts", "id"),
+        Index("ix_eventos_username_ts_id", "username", "ts", "id"),
+    )
 
 class Configuracion(Base):
     __tablename__ = "configuracion"
@@ -214,6 +370,8 @@ class UserDeleteRequest(BaseModel):
 class LecturaHistorial(BaseModel):
     ts: datetime.datetime
     valor: float
+    minimo: Optional[float] = None # Solo en respuestas agregadas (rollups)
+    maximo: Optional[float] = None
 
 class EventoLog(BaseModel):
     ts: datetime.datetime
@@ -223,6 +381,10 @@ class EventoLog(BaseModel):
     detalle: str
     class Config: from_attributes = True
 
+class EventoPagina(BaseModel):
+    items: List[EventoLog]
+    next_cursor: Optional[str] = None # None = no hay más páginas
+
 class ConfiguracionUpdate(BaseModel):
     timeout_desconexion: int
     silencio_alarmas: int
@@ -231,6 +393,7 @@ class ConfiguracionUpdate(BaseModel):
     retencion_conexiones: int
     retencion_auditoria: int
     retencion_accesos: int
+    retencion_lecturas: int = 90
     smtp_host: Optional[str] = None
     smtp_port: Optional[int] = None
     smtp_user: Optional[str] = None
@@ -239,8 +402,14 @@ class ConfiguracionUpdate(BaseModel):
     smtp_tls: bool = False
 
 class ConfiguracionGet(ConfiguracionUpdate):
+    # Con valores por defecto: sirve también de configuración tipada cuando falta algo en la tabla
+    timeout_desconexion: int = 300
+    silencio_alarmas: int = 60
     sonido_alarma: bool = True
     sesion_inactividad: int = 30
+    retencion_conexiones: int = 90
+    retencion_auditoria: int = 365
+    retencion_accesos: int = 180
 
 class RecoveryRequest(BaseModel):
     email: EmailStr
@@ -256,6 +425,24 @@ class RecoveryReset(BaseModel):
     token: str
     new_password: str
 
+# Metadatos mínimos que necesita la ingesta (copia en memoria, ver RegistroMetadatos)
+class NodoMeta(BaseModel):
+    id: str
+    area: Optional[str] = None
+    bateria: Optional[int] = None
+    class Config: from_attributes = True
+
+class SensorMeta(BaseModel):
+    id: str
+    id_nodo: Optional[str] = None
+    nombre_tarjeta: Optional[str] = None
+    tipo: Optional[str] = None
+    unidad: Optional[str] = None
+    limite_alto: Optional[float] = None
+    limite_bajo: Optional[float] = None
+    visible: Optional[bool] = True
+    class Config: from_attributes = True
+
 # --- 5. Funciones Auxiliares ---
 def create_recovery_token(email: str):
     # Token válido por 15 minutos solo para recuperación
@@ -268,16 +455,82 @@ def get_db():
     try: yield db
     finally: db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db: yield db
+
 def get_api_key(x_api_key: str = Header(None)):
     if not x_api_key or x_api_key != API_KEY_SECRET:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="X-API-Key inválida")
     return x_api_key
 
+def get_api_key_telemetria(x_api_key: str = Header(None)):
+    # Igual que get_api_key, salvo que se habilite explícitamente TELEMETRIA_SIN_CLAVE
+    return x_api_key if TELEMETRIA_SIN_CLAVE else get_api_key(x_api_key)
+
+# --- POOL DE BCRYPT (fuera del event loop y con concurrencia acotada) ---
+class PoolContrasenas:
+    """
+    bcrypt tarda ~250 ms por operación: corre en BCRYPT_HILOS hilos propios para no frenar el event loop
+    (Socket.IO, ingesta) ni agotar el threadpool de los endpoints sync. Si ya hay BCRYPT_MAX_PENDIENTES
+    operaciones esperando se responde 503 en lugar de encolar sin límite (ráfagas de login).
+    """
+    def __init__(self, hilos: int, max_pendientes: int):
+        self.hilos = hilos
+        self.max_pendientes = max_pendientes
+        self.executor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="bcrypt")
+        self.lock = threading.Lock()
+        self.pendientes = 0
+        self.total = 0
+        self.rechazadas = 0
+        self.espera_total_ms = 0.0
+        self.espera_max_ms = 0.0
+        self.trabajo_total_ms = 0.0
+
+    def ejecutar(self, fn, *args):
+        with self.lock:
+            if self.pendientes >= self.max_pendientes:
+                self.rechazadas += 1
+                raise HTTPException(503, "Servidor ocupado, reintente en unos segundos")
+            self.pendientes += 1
+        encolado = time.perf_counter()
+
+        def tarea():
+            inicio = time.perf_counter()
+            try: return fn(*args)
+            finally:
+                fin = time.perf_counter()
+                with self.lock:
+                    self.pendientes -= 1
+                    self.total += 1
+                    self.espera_total_ms += (inicio - encolado) * 1000
+                    self.espera_max_ms = max(self.espera_max_ms, (inicio - encolado) * 1000)
+                    self.trabajo_total_ms += (fin - inicio) * 1000
+        return self.executor.submit(tarea)
+
+    def estado(self):
+        with self.lock:
+            return {
+                "hilos": self.hilos,
+                "pendientes": self.pendientes,
+                "total": self.total,
+                "rechazadas": self.rechazadas,
+                "espera_promedio_ms": round(self.espera_total_ms / self.total, 2) if self.total else 0.0,
+                "espera_max_ms": round(self.espera_max_ms, 2),
+                "duracion_promedio_ms": round(self.trabajo_total_ms / self.total, 2) if self.total else 0.0
+            }
+
+pool_contrasenas = PoolContrasenas(BCRYPT_HILOS, BCRYPT_MAX_PENDIENTES)
+
+# Versiones sync: para endpoints `def` (ya corren en un hilo, esperan al pool sin tocar el event loop)
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return pool_contrasenas.ejecutar(pwd_context.verify, plain_password, hashed_password).result()
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return pool_contrasenas.ejecutar(pwd_context.hash, password).result()
+
+# Versiones async: para endpoints `async def`
+async def verify_password_async(plain_password, hashed_password):
+    return await asyncio.wrap_future(pool_contrasenas.ejecutar(pwd_context.verify, plain_password, hashed_password))
 
 def validate_password_complexity(password: str):
     if len(password) < 8: raise HTTPException(400, "Mínimo 8 caracteres")
@@ -294,6 +547,47 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def get_user(db: Session, username: str):
     return db.query(Usuario).filter(Usuario.username == username).first()
 
+# --- CACHÉ DE USUARIOS AUTENTICADOS (LRU con TTL) ---
+class CachePrincipales:
+    """
+    Usuario ya resuelto (datos, rol, activo y áreas suscriptas) por `sub` del token, para no
+    consultar `usuarios` + `suscripciones` en cada request. Vive PRINCIPAL_TTL_SEG segundos y los
+    endpoints que modifican usuarios o contraseñas lo invalidan. No guarda el hash de la contraseña.
+    Se usa desde el event loop y desde los hilos de los endpoints sync: por eso el lock.
+    """
+    def __init__(self, ttl_seg: int, max_items: int):
+        self.ttl_seg = ttl_seg
+        self.max_items = max_items
+        self.items = OrderedDict() # username -> (vence, User)
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, username: str):
+        with self.lock:
+            item = self.items.get(username)
+            if item is None or item[0] < time.monotonic():
+                self.fallos += 1
+                return None
+            self.items.move_to_end(username)
+            self.aciertos += 1
+            return item[1]
+
+    def guardar(self, user: User):
+        if self.ttl_seg <= 0: return
+        with self.lock:
+            self.items[user.username] = (time.monotonic() + self.ttl_seg, user)
+            self.items.move_to_end(user.username)
+            while len(self.items) > self.max_items: self.items.popitem(last=False)
+
+    def invalidar(self, username: str):
+        with self.lock: self.items.pop(username, None)
+
+    def estado(self):
+        return {"usuarios": len(self.items), "aciertos": self.aciertos, "fallos": self.fallos, "ttl_seg": self.ttl_seg}
+
+cache_principales = CachePrincipales(PRINCIPAL_TTL_SEG, PRINCIPAL_MAX)
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
     creds_exc = HTTPException(status.HTTP_401_UNAUTHORIZED, "Credenciales inválidas", {"WWW-Authenticate": "Bearer"})
     try:
@@ -301,10 +595,30 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         username: str = payload.get("sub")
         if username is None: raise creds_exc
     except JWTError: raise creds_exc
-    user = get_user(db, username)
-    if user is None: raise creds_exc
+    user = cache_principales.obtener(username)
+    if user is not None: return user
+    db_user = db.query(Usuario).options(joinedload(Usuario.suscripciones)).filter(Usuario.username == username).first()
+    if db_user is None: raise creds_exc
+    return principal_de(db_user)
+
+def principal_de(db_user: Usuario) -> User:
+    # Usuario de la BD (con suscripciones ya cargadas) -> principal cacheado
+    user = User(
+        username=db_user.username, nombre_completo=db_user.nombre_completo, email=db_user.email, rol=db_user.rol,
+        puesto=db_user.puesto, activo=db_user.activo, suscripciones=[s.area for s in db_user.suscripciones]
+    )
+    cache_principales.guardar(user)
     return user
 
+async def principal_async(username: str) -> Optional[User]:
+    # Igual que get_current_user pero sobre asyncpg: para el handshake de Socket.IO, que corre en el event loop
+    user = cache_principales.obtener(username)
+    if user is not None: return user
+    async with AsyncSessionLocal() as db:
+        q = select(Usuario).options(joinedload(Usuario.suscripciones)).where(Usuario.username == username)
+        db_user = (await db.execute(q)).unique().scalar_one_or_none()
+        return principal_de(db_user) if db_user else None
+
 async def get_current_active_user(current_user: Annotated[User, Depends(get_current_user)]):
     if not current_user.activo: raise HTTPException(400, "Usuario inactivo")
     return current_user
@@ -321,45 +635,876 @@ async def get_current_admin_user(current_user: Annotated[User, Depends(get_curre
     if current_user.rol != "Admin": raise HTTPException(403, "Permisos insuficientes")
     return current_user
 
-# --- TAREA ASÍNCRONA: Enviar Email ---
-async def enviar_email_alerta(conf_dict: dict, destinatarios: List[str], asunto: str, cuerpo: str):
-    try:
-        conf = ConnectionConfig(
-            MAIL_USERNAME = conf_dict.get("smtp_user"),
-            MAIL_PASSWORD = conf_dict.get("smtp_pass"),
-            MAIL_FROM = conf_dict.get("smtp_from"),
-            MAIL_PORT = int(conf_dict.get("smtp_port", 587)),
-            MAIL_SERVER = conf_dict.get("smtp_host"),
-            MAIL_STARTTLS = str(conf_dict.get("smtp_tls")).lower() == "true",
-            MAIL_SSL_TLS = False,
-            USE_CREDENTIALS = True,
-            VALIDATE_CERTS = True
+# --- REGISTRO EN MEMORIA DE NODOS Y SENSORES (Hot path de ingesta) ---
+class RegistroMetadatos:
+    """
+    Copia local (por proceso) de los metadatos de nodos y sensores que usa la ingesta.
+    Se carga al arrancar y los endpoints que modifican nodos/sensores la refrescan,
+    así una lectura en régimen normal no hace ninguna consulta de metadatos.
+    """
+    def __init__(self):
+        self.nodos = {}     # id -> NodoMeta
+        self.sensores = {}  # id -> SensorMeta
+
+    def cargar(self, db: Session):
+        # Reemplazamos los dicts enteros (asignación atómica, sin estados a medias)
+        self.nodos = {n.id: NodoMeta.model_validate(n) for n in db.query(Nodo).all()}
+        self.sensores = {s.id: SensorMeta.model_validate(s) for s in db.query(Sensor).all()}
+        print(f"📋 Registro cargado: {len(self.nodos)} nodos, {len(self.sensores)} sensores.")
+
+    def nodo(self, nid: str): return self.nodos.get(nid)
+    def sensor(self, sid: str): return self.sensores.get(sid)
+
+    def guardar_nodo(self, n: Nodo): self.nodos[n.id] = NodoMeta.model_validate(n)
+    def guardar_sensor(self, s: Sensor): self.sensores[s.id] = SensorMeta.model_validate(s)
+
+    def aplicar(self, nodos: dict, sensores: dict):
+        # Altas y baterías de un lote de ingesta, solo después de su commit
+        self.nodos.update(nodos)
+        self.sensores.update(sensores)
+
+    def refrescar_nodo(self, db: Session, nid: str):
+        n = db.query(Nodo).filter(Nodo.id == nid).first()
+        if n: self.guardar_nodo(n)
+        else: self.nodos.pop(nid, None)
+
+    def refrescar_sensor(self, db: Session, sid: str):
+        s = db.query(Sensor).filter(Sensor.id == sid).first()
+        if s: self.guardar_sensor(s)
+        else: self.sensores.pop(sid, None)
+
+registro = RegistroMetadatos()
+
+# --- ÚLTIMA LECTURA POR SENSOR (tabla `ultima_lectura` + espejo en memoria) ---
+ultimas_lecturas = {} # id_sensor -> {"valor": float, "ts": datetime}
+
+def upsert_ultimas(db: Session, filas: list):
+    # ON CONFLICT no admite tocar la misma fila dos veces en un INSERT: nos quedamos con la más nueva de cada sensor.
+    # Ordenadas por id_sensor: dos transacciones concurrentes bloquean las filas en el mismo orden (sin deadlocks).
+    ultimas = {}
+    for f in filas:
+        actual = ultimas.get(f["id_sensor"])
+        if actual is None or actual["ts"] <= f["ts"]: ultimas[f["id_sensor"]] = f
+    if not ultimas: return
+    stmt = pg_insert(UltimaLectura).values([ultimas[k] for k in sorted(ultimas)])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UltimaLectura.id_sensor],
+        set_={"ts": stmt.excluded.ts, "valor": stmt.excluded.valor},
+        where=UltimaLectura.ts <= stmt.excluded.ts # Un volcado atrasado no pisa un dato más nuevo
+    )
+    db.execute(stmt)
+
+def actualizar_espejo_ultimas(filas: list):
+    for f in filas:
+        actual = ultimas_lecturas.get(f["id_sensor"])
+        if actual is None or actual["ts"] <= f["ts"]:
+            ultimas_lecturas[f["id_sensor"]] = {"valor": f["valor"], "ts": f["ts"]}
+
+# --- ROLLUPS 1 MINUTO / 1 HORA (mantenimiento incremental) ---
+def truncar_ts(ts: datetime.datetime, segundos: int):
+    return datetime.datetime.fromtimestamp(int(ts.timestamp()) // segundos * segundos, tz=datetime.timezone.utc)
+
+def upsert_rollups(db: Session, filas: list):
+    # Se agrega el lote en memoria y se hace UN upsert por nivel que combina min/max/suma/cantidad
+    for modelo, segundos in ROLLUPS:
+        grupos = {}
+        for f in filas:
+            clave = (f["id_sensor"], truncar_ts(f["ts"], segundos))
+            g = grupos.get(clave)
+            if g is None:
+                grupos[clave] = {"id_sensor": clave[0], "bucket": clave[1], "minimo": f["valor"], "maximo": f["valor"], "suma": f["valor"], "cantidad": 1}
+            else:
+                g["minimo"] = min(g["minimo"], f["valor"]); g["maximo"] = max(g["maximo"], f["valor"])
+                g["suma"] += f["valor"]; g["cantidad"] += 1
+        if not grupos: continue
+        # Ordenadas por (id_sensor, bucket): mismo orden de bloqueo en transacciones concurrentes (sin deadlocks)
+        stmt = pg_insert(modelo).values([grupos[k] for k in sorted(grupos)])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[modelo.id_sensor, modelo.bucket],
+            set_={
+                "minimo": func.least(modelo.minimo, stmt.excluded.minimo),
+                "maximo": func.greatest(modelo.maximo, stmt.excluded.maximo),
+                "suma": modelo.suma + stmt.excluded.suma,
+                "cantidad": modelo.cantidad + stmt.excluded.cantidad
+            }
         )
-        message = MessageSchema(
-            subject=asunto,
-            recipients=destinatarios,
-            body=cuerpo,
-            subtype=MessageType.html
+        db.execute(stmt)
+
+def cargar_ultimas(db: Session):
+    # El relleno desde el historial (tabla nueva) corre en segundo plano: ver migrar_en_segundo_plano
+    ultimas_lecturas.clear()
+    for u in db.query(UltimaLectura).all():
+        ultimas_lecturas[u.id_sensor] = {"valor": u.valor, "ts": u.ts}
+
+# --- MOTOR DE ALARMAS (máquina de estados por sensor) ---
+class MotorAlarmas:
+    """
+    Estado de alarma de cada sensor en memoria (NORMAL / ALTA / BAJA) con checkpoint en `estado_alarma`.
+    Solo las transiciones generan evento y notificación:
+      - entrar en alarma (opcionalmente tras ALARMA_DEMORA_SEG fuera de rango),
+      - re-notificar si sigue en alarma cada `silencio_alarmas` minutos,
+      - normalizar cuando el valor vuelve con histéresis (ALARMA_HISTERESIS_PCT).
+    """
+    def __init__(self):
+        self.estados = {} # id_sensor -> {"estado", "desde", "ultima_notificacion", "pendiente", "pendiente_desde"}
+
+    def cargar(self, db: Session):
+        self.estados = {
+            e.id_sensor: {"estado": e.estado, "desde": e.desde, "ultima_notificacion": e.ultima_notificacion, "pendiente": None, "pendiente_desde": None}
+            for e in db.query(EstadoAlarma).all()
+        }
+
+    @staticmethod
+    def margen(sensor: SensorMeta):
+        if sensor.limite_alto is not None and sensor.limite_bajo is not None: base = sensor.limite_alto - sensor.limite_bajo
+        else: base = abs(sensor.limite_alto if sensor.limite_alto is not None else sensor.limite_bajo) or 1.0
+        return abs(base) * ALARMA_HISTERESIS_PCT / 100
+
+    def clasificar(self, sensor: SensorMeta, valor: float, actual: str):
+        alto, bajo = sensor.limite_alto, sensor.limite_bajo
+        if alto is not None and valor > alto: return "ALTA"
+        if bajo is not None and valor < bajo: return "BAJA"
+        # Dentro de límites pero sin superar el margen de histéresis: sigue en alarma (evita el "flapping")
+        if actual == "ALTA" and alto is not None and valor > alto - self.margen(sensor): return "ALTA"
+        if actual == "BAJA" and bajo is not None and valor < bajo + self.margen(sensor): return "BAJA"
+        return "NORMAL"
+
+    def evaluar(self, sensor: SensorMeta, valor: float, ts: datetime.datetime, lote: dict):
+        """
+        Devuelve (tipo_evento, mensaje) si hubo transición, o None. No toca `estados`: trabaja sobre
+        copias guardadas en `lote` (id_sensor -> estado) que se aplican con aplicar() tras el commit.
+        """
+        if not sensor.visible: return None # Sensor sin configurar: no se evalúa
+        e = lote.get(sensor.id)
+        if e is None:
+            actual = self.estados.get(sensor.id)
+            e = dict(actual) if actual else {"estado": "NORMAL", "desde": ts, "ultima_notificacion": None, "pendiente": None, "pendiente_desde": None}
+            lote[sensor.id] = e
+        nuevo = self.clasificar(sensor, valor, e["estado"])
+        unidad = sensor.unidad or ""
+
+        if nuevo == e["estado"]:
+            e["pendiente"] = None
+            silencio = timedelta(minutes=cache_config.conf.silencio_alarmas)
+            # Escalamiento: sigue en alarma y ya pasó el silencio desde el último aviso
+            if nuevo != "NORMAL" and silencio > timedelta(0) and e["ultima_notificacion"] and ts - e["ultima_notificacion"] >= silencio:
+                e["ultima_notificacion"] = ts
+                limite = sensor.limite_alto if nuevo == "ALTA" else sensor.limite_bajo
+                return f"ALARMA_{nuevo}", f"Persiste desde {e['desde'].strftime('%Y-%m-%d %H:%M')}: Valor {valor}{unidad} {'>' if nuevo == 'ALTA' else '<'} {limite}"
+            return None
+
+        # Demora opcional: el valor debe seguir fuera de rango N segundos antes de disparar
+        if nuevo != "NORMAL" and ALARMA_DEMORA_SEG > 0:
+            if e["pendiente"] != nuevo:
+                e["pendiente"], e["pendiente_desde"] = nuevo, ts
+                return None
+            if (ts - e["pendiente_desde"]).total_seconds() < ALARMA_DEMORA_SEG: return None
+
+        previo = e["estado"]
+        e.update({"estado": nuevo, "desde": ts, "ultima_notificacion": ts, "pendiente": None, "pendiente_desde": None})
+        if nuevo == "ALTA": return "ALARMA_ALTA", f"Valor {valor}{unidad} > {sensor.limite_alto}"
+        if nuevo == "BAJA": return "ALARMA_BAJA", f"Valor {valor}{unidad} < {sensor.limite_bajo}"
+        return "ALARMA_NORMALIZADA", f"Valor {valor}{unidad} dentro de límites (estaba en {previo})"
+
+    def aplicar(self, lote: dict):
+        self.estados.update(lote)
+
+    def checkpoint(self, db: Session, lote: dict, ids: set):
+        # Ordenadas por id_sensor: transacciones concurrentes bloquean en el mismo orden (sin deadlocks)
+        filas = [{"id_sensor": sid, "estado": lote[sid]["estado"], "desde": lote[sid]["desde"], "ultima_notificacion": lote[sid]["ultima_notificacion"]} for sid in sorted(ids)]
+        if not filas: return
+        stmt = pg_insert(EstadoAlarma).values(filas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[EstadoAlarma.id_sensor],
+            set_={"estado": stmt.excluded.estado, "desde": stmt.excluded.desde, "ultima_notificacion": stmt.excluded.ultima_notificacion}
         )
-        fm = FastMail(conf)
-        await fm.send_message(message)
-        print(f"📧 Email enviado a {len(destinatarios)} destinatarios.")
-    except Exception as e:
-        print(f"❌ Error enviando email: {e}")
+        db.execute(stmt)
+
+motor_alarmas = MotorAlarmas()
+
+# --- VIGILANCIA DE CONEXIÓN (heap de vencimientos, sin escanear tablas) ---
+class VigilanteConexiones:
+    """
+    Último "visto" de cada sensor en memoria + un heap de vencimientos (visto + timeout_desconexion).
+    Una lectura solo actualiza el dict (O(1)); la entrada del heap se reprograma de forma perezosa
+    cuando vence (O(log n)). Al cruzar el timeout se registra DESCONECTADO (y se avisa al dashboard
+    por el difusor); al volver a reportar, RECONECTADO.
+    """
+    def __init__(self):
+        self.vistos = {}           # id_sensor -> epoch del último dato
+        self.desconectados = set()
+        self.heap = []             # (vence_epoch, id_sensor), una entrada viva por sensor
+        self.programados = set()
+        self.despertar = asyncio.Event()
+        self.timeout = None
+        self.tarea = None
+        self.total_desconexiones = 0
+        self.total_reconexiones = 0
+
+    def cargar(self, db: Session):
+        # Parte de `ultima_lectura` (espejo ya cargado) y del último evento de conexión de cada sensor,
+        # así un reinicio no repite DESCONECTADO de sensores que ya estaban caídos
+        self.timeout = cache_config.conf.timeout_desconexion
+        self.vistos = {sid: d["ts"].timestamp() for sid, d in ultimas_lecturas.items() if d["ts"] is not None}
+        filas = db.execute(text(
+            "SELECT DISTINCT ON (id_sensor) id_sensor, tipo_evento FROM eventos "
+            f"WHERE tipo_evento IN ({_sql_tipos(TIPOS_CONEXION)}) AND id_sensor IS NOT NULL ORDER BY id_sensor, ts DESC"
+        )).all()
+        self.desconectados = {sid for sid, tipo in filas if tipo == "DESCONECTADO" and sid in self.vistos}
+        self.programados = set(self.vistos) - self.desconectados
+        self._reprogramar()
+
+    def _reprogramar(self):
+        self.heap = [(self.vistos[sid] + self.timeout, sid) for sid in self.programados]
+        heapq.heapify(self.heap)
+
+    def conectado(self, sid: str):
+        visto = self.vistos.get(sid)
+        return visto is not None and sid not in self.desconectados and time.time() - visto < (self.timeout or cache_config.conf.timeout_desconexion)
+
+    def desconectado_desde(self, sid: str):
+        """Epoch del último dato si el sensor figura desconectado (sin modificar nada), si no None."""
+        return self.vistos.get(sid) if sid in self.desconectados else None
+
+    def visto(self, sid: str, ts: datetime.datetime):
+        """Registra un dato del sensor. Devuelve el epoch del último dato si estaba desconectado (reconexión), si no None."""
+        previo = self.vistos.get(sid)
+        epoch = ts.timestamp()
+        self.vistos[sid] = epoch
+        if sid not in self.programados:
+            self.programados.add(sid)
+            heapq.heappush(self.heap, (epoch + (self.timeout or cache_config.conf.timeout_desconexion), sid))
+            if self.heap[0][1] == sid: self.despertar.set()
+        if sid not in self.desconectados: return None
+        self.desconectados.discard(sid)
+        self.total_reconexiones += 1
+        return previo
+
+    def _vencidos(self):
+        # Saca del heap los sensores cuyo timeout venció de verdad (los que reportaron se reprograman)
+        timeout = cache_config.conf.timeout_desconexion
+        if timeout != self.timeout:
+            self.timeout = timeout
+            self._reprogramar()
+        ahora = time.time()
+        vencidos = []
+        while self.heap and self.heap[0][0] <= ahora:
+            _, sid = heapq.heappop(self.heap)
+            vence = self.vistos[sid] + timeout
+            if vence > ahora:
+                heapq.heappush(self.heap, (vence, sid))
+                continue
+            self.programados.discard(sid)
+            sensor = registro.sensor(sid)
+            if sensor is None or not sensor.visible or sid in self.desconectados: continue
+            vencidos.append(sid)
+        return vencidos
+
+    @staticmethod
+    def _ultimos_en_bd(ids: list):
+        # Otro worker pudo recibir datos de estos sensores: se confirma contra `ultima_lectura`
+        db = SessionLocal()
+        try: return {u.id_sensor: u.ts.timestamp() for u in db.query(UltimaLectura).filter(UltimaLectura.id_sensor.in_(ids)).all()}
+        finally: db.close()
+
+    def _guardar_eventos(self, caidos: list):
+        db = SessionLocal()
+        try:
+            for sid in caidos:
+                desde = datetime.datetime.fromtimestamp(self.vistos[sid], tz=datetime.timezone.utc)
+                db.add(Evento(tipo_evento="DESCONECTADO", id_sensor=sid, detalle=f"Sin datos desde {desde.strftime('%Y-%m-%d %H:%M:%S')} (timeout {self.timeout}s)"))
+            db.commit()
+        finally:
+            db.close()
+
+    async def _revisar(self):
+        vencidos = self._vencidos()
+        if vencidos:
+            en_bd = await asyncio.to_thread(self._ultimos_en_bd, vencidos)
+            caidos = []
+            for sid in vencidos:
+                if sid in self.programados: continue # Llegó un dato mientras consultábamos
+                if en_bd.get(sid, 0) > self.vistos[sid]:
+                    self.vistos[sid] = en_bd[sid]
+                    self.programados.add(sid)
+                    heapq.heappush(self.heap, (en_bd[sid] + self.timeout, sid))
+                    continue
+                self.desconectados.add(sid)
+                difusor_salas.publicar(sid, conectado=False)
+                caidos.append(sid)
+            if caidos:
+                self.total_desconexiones += len(caidos)
+                await asyncio.to_thread(self._guardar_eventos, caidos)
+
+    async def _ciclo(self):
+        while True:
+            try: await self._revisar()
+            except Exception as e: print(f"❌ Error en la vigilancia de conexión: {e}")
+            espera = self.heap[0][0] - time.time() if self.heap else self.timeout
+            try: await asyncio.wait_for(self.despertar.wait(), timeout=max(0.05, espera))
+            except asyncio.TimeoutError: pass
+            self.despertar.clear()
+
+    def iniciar(self):
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ciclo())
+            print(f"⏱️ Vigilancia de conexión activa ({len(self.vistos)} sensores, timeout {self.timeout}s).")
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            try: await self.tarea
+            except asyncio.CancelledError: pass
+            self.tarea = None
+
+    def estado(self):
+        return {
+            "activo": self.tarea is not None,
+            "sensores": len(self.vistos),
+            "desconectados": len(self.desconectados),
+            "programados": len(self.heap),
+            "total_desconexiones": self.total_desconexiones,
+            "total_reconexiones": self.total_reconexiones
+        }
+
+vigilante_conexiones = VigilanteConexiones()
+
+# --- DIFUSIÓN AL DASHBOARD (salas por área + frames agrupados) ---
+class DifusorSalas:
+    """
+    Los navegadores se autentican al conectar y entran a la sala de cada área suscripta
+    (`area:<nombre>`; los Admin a `admin`, que recibe todo). Las novedades por sensor se
+    acumulan y cada DIFUSION_MS sale UN frame 'lecturas' por sala, solo con los sensores que cambiaron.
+
+    Cada tick lleva un número de secuencia (`seq`, dentro de la `epoca` de este proceso) y se guarda
+    en un anillo de SYNC_HISTORIAL_FRAMES frames: un cliente que se reconecta pide 'sincronizar' con su
+    último `seq` y recibe solo los cambios desde entonces; si quedó fuera del anillo (o el proceso
+    se reinició) recibe un snapshot armado en memoria, sin tocar la BD.
+    """
+    def __init__(self, intervalo_ms: int, historial_frames: int):
+        self.intervalo_ms = intervalo_ms
+        self.pendientes = {}         # id_sensor -> campos cambiados desde el último frame
+        self.enviados = {}           # id_sensor -> último estado emitido
+        self.sesiones = {}           # sid de Socket.IO -> (username, rol, areas)
+        self.reasignaciones = {}     # username -> (rol, areas); lo aplica el ciclo (los endpoints sync corren en hilos)
+        self.epoca = f"{int(time.time())}-{os.getpid()}"
+        self.seq = 0
+        self.historial = deque(maxlen=historial_frames) # (seq, items) de los últimos frames
+        self.tarea = None
+        self.total_frames = 0
+        self.total_sensores = 0
+        self.total_deltas = 0
+        self.total_snapshots = 0
+
+    @staticmethod
+    def salas(rol: Optional[str], areas: List[str]):
+        if rol is None: return []
+        return ["admin"] if rol == "Admin" else [f"area:{a}" for a in areas]
+
+    async def conectar(self, sid: str, username: str, rol: str, areas: List[str]):
+        self.sesiones[sid] = (username, rol, areas)
+        for sala in self.salas(rol, areas): await sio.enter_room(sid, sala)
+
+    def desconectar(self, sid: str): self.sesiones.pop(sid, None)
+
+    def reasignar(self, username: str, rol: Optional[str], areas: List[str]):
+        # rol None = usuario borrado o inactivo: se cierran sus sockets
+        self.reasignaciones[username] = (rol, list(areas))
+
+    def publicar(self, id_sensor: str, **campos):
+        actual = {**self.enviados.get(id_sensor, {}), **self.pendientes.get(id_sensor, {})}
+        cambios = {k: v for k, v in campos.items() if actual.get(k) != v}
+        if cambios: self.pendientes.setdefault(id_sensor, {}).update(cambios)
+
+    async def _aplicar_reasignaciones(self):
+        while self.reasignaciones:
+            username, (rol, areas) = self.reasignaciones.popitem()
+            for sid in [s for s, sesion in self.sesiones.items() if sesion[0] == username]:
+                if rol is None:
+                    await sio.disconnect(sid)
+                    continue
+                self.sesiones[sid] = (username, rol, areas)
+                for sala in sio.rooms(sid):
+                    if sala == "admin" or sala.startswith("area:"): await sio.leave_room(sid, sala)
+                for sala in self.salas(rol, areas): await sio.enter_room(sid, sala)
+
+    @staticmethod
+    def _area(id_sensor: str):
+        sensor = registro.sensor(id_sensor)
+        nodo = registro.nodo(sensor.id_nodo) if sensor else None
+        return nodo.area if nodo else None
+
+    async def emitir(self):
+        if self.reasignaciones: await self._aplicar_reasignaciones()
+        if not self.pendientes: return
+        pendientes, self.pendientes = self.pendientes, {}
+        por_sala = {"admin": []}
+        for sid, campos in pendientes.items():
+            self.enviados.setdefault(sid, {}).update(campos)
+            item = {"id": sid, **campos}
+            por_sala["admin"].append(item)
+            area = self._area(sid)
+            if area and area != "Pendiente": por_sala.setdefault(f"area:{area}", []).append(item)
+        self.seq += 1
+        self.historial.append((self.seq, por_sala["admin"]))
+        t = int(time.time() * 1000)
+        for sala, items in por_sala.items():
+            await sio.emit('lecturas', {"t": t, "epoca": self.epoca, "seq": self.seq, "sensores": items}, room=sala)
+            self.total_frames += 1
+            self.total_sensores += len(items)
+
+    def sincronizar(self, sid: str, epoca: Optional[str], seq: Optional[int]):
+        """Delta desde `seq` si el anillo todavía lo cubre; si no, snapshot de las áreas del cliente."""
+        sesion = self.sesiones.get(sid)
+        if sesion is None: return {"tipo": "error", "detalle": "Socket sin autenticar"}
+        _, rol, areas = sesion
+        visible = lambda id_sensor: rol == "Admin" or self._area(id_sensor) in areas
+        cubierto = isinstance(seq, int) and epoca == self.epoca and 0 <= seq <= self.seq and (
+            seq == self.seq or (self.historial and self.historial[0][0] <= seq + 1)
+        )
+        if cubierto:
+            cambios = {}
+            for s, items in self.historial:
+                if s <= seq: continue
+                for item in items:
+                    if visible(item["id"]): cambios.setdefault(item["id"], {}).update(item)
+            self.total_deltas += 1
+            return {"tipo": "delta", "epoca": self.epoca, "seq": self.seq, "sensores": list(cambios.values())}
+
+        # Snapshot desde memoria: registro + espejo de últimas lecturas + vigilancia de conexión
+        sensores = []
+        for s in registro.sensores.values():
+            if not visible(s.id): continue
+            nodo = registro.nodo(s.id_nodo)
+            dato = ultimas_lecturas.get(s.id)
+            sensores.append({
+                "id": s.id,
+                "valor": dato["valor"] if dato else None,
+                "bateria": nodo.bateria if nodo else None,
+                "conectado": vigilante_conexiones.conectado(s.id)
+            })
+        self.total_snapshots += 1
+        return {"tipo": "snapshot", "epoca": self.epoca, "seq": self.seq, "sensores": sensores}
+
+    async def _ciclo(self):
+        while True:
+            await asyncio.sleep(self.intervalo_ms / 1000)
+            try: await self.emitir()
+            except Exception as e: print(f"❌ Error difundiendo lecturas: {e}")
+
+    def iniciar(self):
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ciclo())
+            print(f"📡 Difusión por salas activa (frame cada {self.intervalo_ms} ms).")
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            try: await self.tarea
+            except asyncio.CancelledError: pass
+            self.tarea = None
+
+    def estado(self):
+        return {
+            "activo": self.tarea is not None,
+            "clientes": len(self.sesiones),
+            "pendientes": len(self.pendientes),
+            "seq": self.seq,
+            "historial_frames": len(self.historial),
+            "total_frames": self.total_frames,
+            "total_sensores": self.total_sensores,
+            "total_deltas": self.total_deltas,
+            "total_snapshots": self.total_snapshots
+        }
+
+difusor_salas = DifusorSalas(DIFUSION_MS, SYNC_HISTORIAL_FRAMES)
+
+# --- BUFFER WRITE-BEHIND DE LECTURAS (Group commit) ---
+class BufferLecturas:
+    """
+    Cola acotada en memoria de filas de `lecturas`. Una tarea escritora la vuelca a la BD
+    cada BUFFER_FLUSH_FILAS filas o cada BUFFER_FLUSH_MS ms, con un único INSERT multi-fila
+    por volcado. Todo el acceso a la cola ocurre en el event loop; el INSERT corre en un hilo.
+    Si una tanda falla varias veces seguidas se parte a la mitad hasta aislar las filas que no
+    entran ni solas (p.ej. FK de un sensor borrado): esas se descartan y se registran.
+    """
+    def __init__(self, max_filas: int, flush_filas: int, flush_ms: int, reintentos: int, cierre_seg: float):
+        self.max_filas = max_filas
+        self.flush_filas = flush_filas
+        self.flush_ms = flush_ms
+        self.reintentos = reintentos
+        self.cierre_seg = cierre_seg
+        self.cola = deque()
+        self.reservadas = 0   # Lugar tomado por requests que todavía no encolaron (ver reservar)
+        self.fallos_tanda = 0 # Fallos seguidos de la tanda del frente de la cola
+        self.ultimas_descartadas = deque(maxlen=100)
+        self.hay_datos = asyncio.Event()
+        self.tarea = None
+        self.cerrando = False
+        # Métricas
+        self.total_filas = 0
+        self.total_flushes = 0
+        self.rechazadas = 0
+        self.errores = 0
+        self.descartadas = 0
+        self.ultimo_flush_filas = 0
+        self.ultimo_flush_ms = 0.0
+
+    def reservar(self, n: int):
+        # Se reserva antes de procesar el lote y se libera al encolar: entre medio hay awaits
+        # (run_sync sobre asyncpg) y otros requests no deben poder pasar el tope.
+        # Todo corre en el event loop, así que chequear y sumar es atómico.
+        if len(self.cola) + self.reservadas + n > self.max_filas:
+            self.rechazadas += n
+            raise HTTPException(503, "Buffer de ingesta lleno, reintente más tarde")
+        self.reservadas += n
+
+    def liberar(self, n: int):
+        self.reservadas -= n
+
+    def encolar(self, filas: list, reservadas: int):
+        self.reservadas -= reservadas
+        self.cola.extend(filas)
+        if len(self.cola) >= self.flush_filas: self.hay_datos.set()
+
+    def _insertar(self, filas: list):
+        db = SessionLocal()
+        try:
+            db.execute(insert(Lectura), filas)
+            upsert_ultimas(db, filas)
+            upsert_rollups(db, filas)
+            db.commit()
+        finally:
+            db.close()
+
+    def _insertar_aislando(self, filas: list):
+        # Bisección: mitades que fallan por datos se vuelven a partir hasta la fila suelta.
+        # Un error de conexión corta y devuelve lo que falta (sin duplicar lo ya insertado).
+        pendientes, malas = [filas], []
+        while pendientes:
+            tanda = pendientes.pop()
+            try: self._insertar(tanda)
+            except OperationalError:
+                return malas, tanda + [f for t in reversed(pendientes) for f in t]
+            except Exception as e:
+                if len(tanda) == 1: malas.append((tanda[0], e))
+                else: pendientes += [tanda[len(tanda) // 2:], tanda[:len(tanda) // 2]]
+        return malas, []
+
+    def descartar(self, malas: list):
+        # Una sola línea de log por tanda (el detalle de cada fila queda en ultimas_descartadas)
+        if not malas: return
+        for fila, e in malas:
+            self.descartadas += 1
+            detalle = str(e).splitlines()[0]
+            self.ultimas_descartadas.append({"ts": fila["ts"].isoformat(), "id_sensor": fila["id_sensor"], "valor": fila["valor"], "error": detalle})
+        fila, e = malas[0]
+        print(f"🗑️ {len(malas)} lecturas descartadas en la tanda (primera: {fila['id_sensor']} = {fila['valor']} @ {fila['ts'].isoformat()}: {str(e).splitlines()[0]})")
+
+    async def vaciar(self):
+        # Vuelca la cola en tandas de hasta flush_filas filas
+        while self.cola:
+            n = min(len(self.cola), self.flush_filas)
+            filas = [self.cola.popleft() for _ in range(n)]
+            inicio = time.perf_counter()
+            try:
+                malas = []
+                if self.fallos_tanda < self.reintentos:
+                    await asyncio.to_thread(self._insertar, filas)
+                    resto, error = [], None
+                else:
+                    malas, resto = await asyncio.to_thread(self._insertar_aislando, filas)
+                    self.descartar(malas)
+                    error = "se perdió la conexión con la BD"
+            except Exception as e:
+                resto, error = filas, e
+            if resto:
+                # Vuelven al frente de la cola; tras `reintentos` fallos seguidos se aíslan las filas malas
+                self.errores += 1
+                self.fallos_tanda += 1
+                self.cola.extendleft(reversed(resto))
+                print(f"❌ Error volcando {len(resto)} lecturas (intento {self.fallos_tanda}): {error}")
+                return
+            self.fallos_tanda = 0
+            self.ultimo_flush_filas = n - len(malas)
+            self.ultimo_flush_ms = (time.perf_counter() - inicio) * 1000
+            self.total_filas += n - len(malas)
+            self.total_flushes += 1
+
+    async def _escritor(self):
+        while not self.cerrando:
+            try: await asyncio.wait_for(self.hay_datos.wait(), timeout=self.flush_ms / 1000)
+            except asyncio.TimeoutError: pass
+            self.hay_datos.clear()
+            await self.vaciar()
+
+    def iniciar(self):
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._escritor())
+            print(f"📥 Ingesta asíncrona activa (flush {self.flush_filas} filas / {self.flush_ms} ms).")
+
+    async def detener(self):
+        # Sin cancelar: un volcado en curso ya sacó sus filas de la cola y se perderían sin rastro
+        if self.tarea:
+            self.cerrando = True
+            self.hay_datos.set()
+            await self.tarea
+            self.tarea = None
+        # Volcado final acotado: las filas ya se confirmaron con 202, se insiste hasta cierre_seg
+        # (pasados los reintentos se aíslan las filas malas, así una sola no frena el resto)
+        limite = time.monotonic() + self.cierre_seg
+        while True:
+            await self.vaciar()
+            if not self.cola or time.monotonic() >= limite: break
+            await asyncio.sleep(min(1.0, max(0.0, limite - time.monotonic())))
+        if self.cola: print(f"⚠️ Quedaron {len(self.cola)} lecturas sin volcar al apagar (BD no disponible durante {self.cierre_seg:.0f}s).")
+
+    def estado(self):
+        return {
+            "activo": self.tarea is not None,
+            "profundidad": len(self.cola),
+            "capacidad": self.max_filas,
+            "ultimo_flush_filas": self.ultimo_flush_filas,
+            "ultimo_flush_ms": round(self.ultimo_flush_ms, 2),
+            "total_filas": self.total_filas,
+            "total_flushes": self.total_flushes,
+            "rechazadas": self.rechazadas,
+            "errores": self.errores,
+            "descartadas": self.descartadas,
+            "ultimas_descartadas": list(self.ultimas_descartadas)
+        }
+
+buffer_lecturas = BufferLecturas(BUFFER_MAX_FILAS, BUFFER_FLUSH_FILAS, BUFFER_FLUSH_MS, BUFFER_REINTENTOS, BUFFER_CIERRE_SEG)
+
+# --- CACHÉ DE CONFIGURACIÓN (versionada, recargada por LISTEN/NOTIFY) ---
+CANAL_CONFIG = "hisens_config" # Canal de Postgres para avisar cambios de configuración entre workers
+
+class CacheConfiguracion:
+    """
+    Configuración tipada (ConfiguracionGet) cargada una vez en memoria. Cada recarga arma un
+    snapshot nuevo y lo publica con una sola asignación, así los lectores nunca ven una mezcla.
+    upd_conf la recarga al escribir y hace NOTIFY para que el resto de los workers la recargue.
+    """
+    def __init__(self):
+        self._snapshot = (0, ConfiguracionGet(), {}) # (versión, conf tipada, valores crudos)
+
+    @property
+    def version(self): return self._snapshot[0]
+    @property
+    def conf(self) -> ConfiguracionGet: return self._snapshot[1]
+    @property
+    def valores(self) -> dict: return self._snapshot[2] # Strings tal como están en la tabla (para SMTP)
+
+    def cargar(self, db: Session):
+        valores = {i.id: i.valor for i in db.query(Configuracion).all() if i.valor not in (None, "", "None")}
+        try:
+            conf = ConfiguracionGet(**valores)
+        except ValidationError as e:
+            print(f"⚠️ Configuración inválida en la BD, se mantiene la versión {self.version}: {e}")
+            return
+        self._snapshot = (self.version + 1, conf, valores)
+
+    def recargar(self):
+        db = SessionLocal()
+        try: self.cargar(db)
+        finally: db.close()
+
+cache_config = CacheConfiguracion()
+_conexion_listen = None
+
+async def escuchar_cambios_config():
+    # Conexión dedicada en autocommit con LISTEN; el event loop nos avisa cuando llega un NOTIFY
+    global _conexion_listen
+    import psycopg2
+    loop = asyncio.get_running_loop()
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    conn = await asyncio.to_thread(psycopg2.connect, dsn)
+    conn.autocommit = True
+    conn.cursor().execute(f"LISTEN {CANAL_CONFIG}")
+
+    def al_recibir():
+        conn.poll()
+        if conn.notifies:
+            conn.notifies.clear()
+            loop.create_task(asyncio.to_thread(cache_config.recargar))
+
+    loop.add_reader(conn.fileno(), al_recibir)
+    _conexion_listen = conn
+    print(f"🔔 Escuchando cambios de configuración ({CANAL_CONFIG}).")
+
+def cerrar_escucha_config():
+    global _conexion_listen
+    if _conexion_listen is None: return
+    try:
+        asyncio.get_running_loop().remove_reader(_conexion_listen.fileno())
+        _conexion_listen.close()
+    except Exception: pass
+    _conexion_listen = None
+
+# --- DESPACHADOR DE EMAILS (pool SMTP persistente, cola acotada, límites y digests) ---
+class DespachadorEmails:
+    """
+    Envío de emails fuera de los requests. EMAIL_CONEXIONES workers mantienen cada uno una
+    conexión SMTP abierta (se reconecta si se cae o si cambia la configuración) y consumen una
+    cola con prioridad. Las alertas se acumulan por destinatario y salen agrupadas cada EMAIL_DIGEST_SEG;
+    cada destinatario recibe como máximo EMAIL_MAX_POR_HORA alertas. Los emails transaccionales tienen
+    su propio límite, salen antes que las alertas y no se descartan por cola llena (una tormenta de
+    alarmas no frena una recuperación de contraseña). Los fallos se reintentan con backoff.
+    """
+    def __init__(self, conexiones: int, max_cola: int, max_por_hora: int, max_transaccionales: int, digest_seg: int, reintentos: int):
+        self.conexiones = conexiones
+        self.max_cola = max_cola # Solo acota las alertas
+        self.max_por_hora = max_por_hora
+        self.max_transaccionales = max_transaccionales
+        self.digest_seg = digest_seg
+        self.reintentos = reintentos
+        self.cola = asyncio.PriorityQueue() # (prioridad, orden, msg): 0 = transaccional, 1 = alerta
+        self.orden = itertools.count()      # Desempate FIFO dentro de cada prioridad
+        self.pendientes = {} # email -> [(asunto, cuerpo)] alertas esperando el próximo digest
+        self.envios = {}     # email -> deque de instantes de envío de alertas (ventana de 1 hora)
+        self.envios_transaccionales = {} # Ídem para emails transaccionales
+        self.tareas = []
+        self.metricas = {"encolados": 0, "enviados": 0, "fallidos": 0, "reintentos": 0, "descartados_cola": 0, "descartados_limite": 0, "descartados_limite_transaccional": 0, "digests": 0, "ultimo_envio_ms": 0.0}
+
+    # --- Límite por destinatario ---
+    @staticmethod
+    def _permitido(envios: dict, email: str, ahora: float, limite: int):
+        ventana = envios.setdefault(email, deque())
+        while ventana and ahora - ventana[0] > 3600: ventana.popleft()
+        return len(ventana) < limite
+
+    def _poner(self, msg: dict):
+        if not msg["transaccional"] and self.cola.qsize() >= self.max_cola:
+            self.metricas["descartados_cola"] += 1
+            print(f"⚠️ Cola de emails llena, se descarta: {msg['asunto']}")
+            return
+        self.cola.put_nowait((0 if msg["transaccional"] else 1, next(self.orden), msg))
+
+    # --- Entrada ---
+    def encolar_alerta(self, destinatarios: List[str], asunto: str, cuerpo: str):
+        for d in destinatarios:
+            lista = self.pendientes.setdefault(d, [])
+            lista.append((asunto, cuerpo))
+            if len(lista) > 100: # Destinatario limitado por mucho tiempo: se conservan las más recientes
+                lista.pop(0); self.metricas["descartados_limite"] += 1
+        self.metricas["encolados"] += len(destinatarios)
+        if self.digest_seg <= 0: self._armar_digests()
+
+    def encolar(self, destinatarios: List[str], asunto: str, cuerpo: str):
+        # Emails transaccionales (p.ej. recuperación de contraseña): salen ya, sin agrupar y con su propio límite
+        ahora = time.monotonic()
+        for d in destinatarios:
+            self.metricas["encolados"] += 1
+            if not self._permitido(self.envios_transaccionales, d, ahora, self.max_transaccionales):
+                self.metricas["descartados_limite_transaccional"] += 1
+                print(f"⚠️ Límite de emails transaccionales alcanzado para {d}: {asunto}")
+                continue
+            self.envios_transaccionales[d].append(ahora)
+            self._poner({"para": d, "asunto": asunto, "cuerpo": cuerpo, "intentos": 0, "transaccional": True})
+
+    def _armar_digests(self):
+        ahora = time.monotonic()
+        for email in list(self.pendientes):
+            if not self._permitido(self.envios, email, ahora, self.max_por_hora): continue # Sigue pendiente hasta que se libere la ventana
+            items = self.pendientes.pop(email)
+            self.envios[email].append(ahora)
+            if len(items) == 1:
+                asunto, cuerpo = items[0]
+            else:
+                asunto = f"Resumen HI-SENS: {len(items)} alertas"
+                cuerpo = f"<h2>📋 {len(items)} alertas</h2>" + "<hr>".join(c for _, c in items)
+                self.metricas["digests"] += 1
+            self._poner({"para": email, "asunto": asunto, "cuerpo": cuerpo, "intentos": 0, "transaccional": False})
+
+    async def _ciclo_digest(self):
+        while True:
+            await asyncio.sleep(self.digest_seg)
+            self._armar_digests()
+
+    # --- Salida ---
+    async def _conectar(self):
+        v = cache_config.valores
+        smtp = aiosmtplib.SMTP(
+            hostname=v.get("smtp_host"), port=int(v.get("smtp_port", 587)),
+            start_tls=str(v.get("smtp_tls")).lower() == "true", validate_certs=True, timeout=30
+        )
+        await smtp.connect()
+        if v.get("smtp_user"): await smtp.login(v["smtp_user"], v.get("smtp_pass", ""))
+        return smtp
+
+    def _reintentar(self, msg: dict, error: Exception):
+        msg["intentos"] += 1
+        if msg["intentos"] > self.reintentos:
+            self.metricas["fallidos"] += 1
+            print(f"❌ Error enviando email a {msg['para']} (sin más reintentos): {error}")
+            return
+        self.metricas["reintentos"] += 1
+        asyncio.get_running_loop().call_later(min(300, 2 ** msg["intentos"]), self._poner, msg)
+
+    async def _worker(self):
+        smtp, version = None, None
+        while True:
+            _, _, msg = await self.cola.get()
+            try:
+                if smtp is None or not smtp.is_connected or version != cache_config.version:
+                    if smtp is not None:
+                        try: await smtp.quit()
+                        except Exception: pass
+                    smtp, version = await self._conectar(), cache_config.version
+                email = EmailMessage()
+                email["From"] = cache_config.valores.get("smtp_from")
+                email["To"] = msg["para"]
+                email["Subject"] = msg["asunto"]
+                email.set_content(msg["cuerpo"], subtype="html")
+                inicio = time.perf_counter()
+                await smtp.send_message(email)
+                self.metricas["ultimo_envio_ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+                self.metricas["enviados"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                smtp = None # Conexión en estado dudoso: se rehace en el próximo envío
+                self._reintentar(msg, e)
+            finally:
+                self.cola.task_done()
+
+    def iniciar(self):
+        if self.tareas: return
+        self.tareas = [asyncio.create_task(self._worker()) for _ in range(self.conexiones)]
+        if self.digest_seg > 0: self.tareas.append(asyncio.create_task(self._ciclo_digest()))
+        print(f"📧 Despachador de emails activo ({self.conexiones} conexiones, digest {self.digest_seg}s).")
+
+    async def detener(self, espera_seg: float = 10):
+        # Se envían los digests pendientes y se da un margen para vaciar la cola
+        self._armar_digests()
+        try: await asyncio.wait_for(self.cola.join(), timeout=espera_seg)
+        except asyncio.TimeoutError: print(f"⚠️ Quedaron {self.cola.qsize()} emails sin enviar al apagar.")
+        for t in self.tareas: t.cancel()
+        self.tareas = []
+
+    def estado(self):
+        return {
+            **self.metricas,
+            "profundidad": self.cola.qsize(),
+            "pendientes_digest": sum(len(v) for v in self.pendientes.values()),
+            "conexiones": self.conexiones,
+            "activo": bool(self.tareas)
+        }
+
+despachador_emails = DespachadorEmails(EMAIL_CONEXIONES, EMAIL_MAX_COLA, EMAIL_MAX_POR_HORA, EMAIL_MAX_TRANSACCIONALES_POR_HORA, EMAIL_DIGEST_SEG, EMAIL_REINTENTOS)
 
 # --- TAREA PROGRAMADA: Limpieza de Datos ---
 async def ejecutar_limpieza_diaria():
     print("🧹 Ejecutando limpieza automática de datos...")
     db = SessionLocal()
     try:
-        # 1. Leer configuración
-        configs = db.query(Configuracion).all()
-        conf = {c.id: int(c.valor) for c in configs if c.valor and c.valor.isdigit()}
+        # 1. Leer configuración (caché)
+        conf = cache_config.conf
         
         # 2. Definir límites (días)
-        dias_conex = conf.get("retencion_conexiones", 90)
-        dias_audit = conf.get("retencion_auditoria", 365)
-        dias_acceso = conf.get("retencion_accesos", 180)
+        dias_conex = conf.retencion_conexiones
+        dias_audit = conf.retencion_auditoria
+        dias_acceso = conf.retencion_accesos
         
         ahora = datetime.datetime.now(datetime.timezone.utc)
 
@@ -367,29 +1512,34 @@ async def ejecutar_limpieza_diaria():
         # Accesos (Login)
         fecha_acceso = ahora - timedelta(days=dias_acceso)
         db.query(Evento).filter(
-            Evento.tipo_evento.in_(["LOGIN_EXITOSO", "LOGIN_FALLIDO"]),
+            Evento.tipo_evento.in_(TIPOS_ACCESO),
             Evento.ts < fecha_acceso
         ).delete(synchronize_session=False)
 
         # Conexiones (Sensores)
         fecha_conex = ahora - timedelta(days=dias_conex)
         db.query(Evento).filter(
-            Evento.tipo_evento.in_(["DESCONECTADO", "RECONECTADO"]),
+            Evento.tipo_evento.in_(TIPOS_CONEXION),
             Evento.ts < fecha_conex
         ).delete(synchronize_session=False)
 
         # Auditoría (Resto)
         fecha_audit = ahora - timedelta(days=dias_audit)
         db.query(Evento).filter(
-            Evento.tipo_evento.notin_(["LOGIN_EXITOSO", "LOGIN_FALLIDO", "DESCONECTADO", "RECONECTADO"]),
+            Evento.tipo_evento.notin_(TIPOS_ACCESO + TIPOS_CONEXION),
             Evento.ts < fecha_audit
         ).delete(synchronize_session=False)
 
-        # 4. Limpiar LECTURAS (Crítico: Usamos 90 días por defecto para no saturar)
-        # Se asume una retención prudente para las series temporales
-        dias_lecturas = 90
+        # 4. Limpiar LECTURAS (retención configurable, 90 días por defecto)
+        dias_lecturas = conf.retencion_lecturas
         fecha_lecturas = ahora - timedelta(days=dias_lecturas)
-        db.query(Lectura).filter(Lectura.ts < fecha_lecturas).delete(synchronize_session=False)
+        if TIMESCALE_ACTIVO:
+            # Hypertable: se descartan chunks enteros (instantáneo, sin DELETE fila a fila ni VACUUM)
+            db.execute(text("SELECT drop_chunks('lecturas', older_than => CAST(:limite AS timestamptz))"), {"limite": fecha_lecturas})
+        else:
+            db.query(Lectura).filter(Lectura.ts < fecha_lecturas).delete(synchronize_session=False)
+        for modelo, _ in ROLLUPS:
+            db.query(modelo).filter(modelo.bucket < fecha_lecturas).delete(synchronize_session=False)
 
         db.commit()
         print("✅ Limpieza completada.")
@@ -401,14 +1551,149 @@ async def ejecutar_limpieza_diaria():
         db.close()
 
 
+# --- MIGRACIÓN: índices nuevos en tablas existentes (create_all solo los crea con la tabla) ---
+def crear_indices_faltantes(conn):
+    # CONCURRENTLY (conn en AUTOCOMMIT): construir el índice sobre una tabla grande no bloquea escrituras
+    for tabla in Base.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            valido = conn.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :nombre"
+            ), {"nombre": indice.name}).scalar()
+            if valido: continue
+            # Un CONCURRENTLY cortado deja el índice INVALID: se borra y se vuelve a construir
+            if valido is False: conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{indice.name}"'))
+            print(f"🔧 Creando el índice {indice.name} (CONCURRENTLY)...")
+            indice.dialect_options["postgresql"]["concurrently"] = True
+            try: indice.create(bind=conn)
+            except Exception as e:
+                print(f"⚠️ No se pudo crear el índice {indice.name}: {e}")
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{indice.name}"'))
+            finally: indice.dialect_options["postgresql"]["concurrently"] = False
+
+# --- MIGRACIÓN: rellenos únicos desde el historial (tablas derivadas nuevas) ---
+CLAVE_LOCK_MIGRACION = 48151623 # pg_advisory_lock: un solo worker corre la migración en segundo plano
+
+def _sql_relleno_rollup(modelo, segundos: int):
+    # Combina con lo que ya sumó la ingesta: los tramos no se solapan, cada lectura se cuenta una vez
+    t = modelo.__tablename__
+    return (
+        f"INSERT INTO {t} (id_sensor, bucket, minimo, maximo, suma, cantidad) "
+        f"SELECT id_sensor, to_timestamp(floor(extract(epoch FROM ts) / {segundos}) * {segundos}) AS b, "
+        "min(valor), max(valor), sum(valor), count(*) FROM lecturas WHERE ts >= :desde AND ts < :hasta GROUP BY id_sensor, b "
+        f"ON CONFLICT (id_sensor, bucket) DO UPDATE SET minimo = least({t}.minimo, EXCLUDED.minimo), "
+        f"maximo = greatest({t}.maximo, EXCLUDED.maximo), suma = {t}.suma + EXCLUDED.suma, cantidad = {t}.cantidad + EXCLUDED.cantidad"
+    )
+
+SQL_RELLENO_ULTIMAS = (
+    "INSERT INTO ultima_lectura (id_sensor, ts, valor) "
+    "SELECT DISTINCT ON (id_sensor) id_sensor, ts, valor FROM lecturas WHERE ts >= :desde AND ts < :hasta ORDER BY id_sensor, ts DESC "
+    "ON CONFLICT (id_sensor) DO UPDATE SET ts = EXCLUDED.ts, valor = EXCLUDED.valor WHERE ultima_lectura.ts < EXCLUDED.ts "
+    "RETURNING id_sensor, ts, valor"
+)
+
+RELLENOS = [("migracion_ultima_lectura", UltimaLectura, SQL_RELLENO_ULTIMAS)] + [
+    (f"migracion_{modelo.__tablename__}", modelo, _sql_relleno_rollup(modelo, segundos)) for modelo, segundos in ROLLUPS
+]
+
+def preparar_rellenos(db: Session):
+    """
+    Marca (en `configuracion`) desde dónde rellenar cada tabla derivada. Corre en el arranque, antes de
+    aceptar lecturas: una tabla vacía se rellena hacia atrás desde ahora (lo nuevo lo escribe la ingesta);
+    una con datos ya fue calculada por una versión anterior. Si otro worker ya la marcó, se respeta.
+    """
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    for clave, tabla, _ in RELLENOS:
+        if db.get(Configuracion, clave) is not None: continue
+        marca = ahora.isoformat() if db.query(tabla).first() is None else "listo"
+        db.execute(pg_insert(Configuracion).values(id=clave, valor=marca).on_conflict_do_nothing())
+    db.commit()
+
+def rellenar_desde_historial(db: Session, clave: str, tabla, sql: str, al_confirmar=None):
+    # Hacia atrás en tramos de MIGRACION_VENTANA_HORAS: cada tramo y su marca de avance van en la misma
+    # transacción (corta, no frena la ingesta) y un reinicio retoma donde quedó sin contar dos veces
+    item = db.get(Configuracion, clave)
+    if item is None or item.valor == "listo": return
+    hasta = datetime.datetime.fromisoformat(item.valor)
+    minimo = db.query(func.min(Lectura.ts)).scalar()
+    if minimo is not None and minimo < hasta: print(f"🔁 Rellenando `{tabla.__tablename__}` desde el historial (en segundo plano)...")
+    while minimo is not None and minimo < hasta:
+        desde = hasta - timedelta(hours=MIGRACION_VENTANA_HORAS)
+        res = db.execute(text(sql), {"desde": desde, "hasta": hasta})
+        filas = [dict(r._mapping) for r in res] if res.returns_rows else []
+        item.valor = desde.isoformat()
+        db.commit()
+        if al_confirmar and filas: al_confirmar(filas)
+        hasta = desde
+    item.valor = "listo"
+    db.commit()
+
+def migrar(loop: asyncio.AbstractEventLoop):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": CLAVE_LOCK_MIGRACION}).scalar(): return # Ya la corre otro worker
+        db = SessionLocal()
+        try:
+            crear_indices_faltantes(conn)
+            for clave, tabla, sql in RELLENOS:
+                # El espejo en memoria lo toca el event loop (igual que la ingesta)
+                espejo = (lambda filas: loop.call_soon_threadsafe(actualizar_espejo_ultimas, filas)) if tabla is UltimaLectura else None
+                rellenar_desde_historial(db, clave, tabla, sql, espejo)
+            print("✅ Migración en segundo plano completada.")
+        except Exception as e:
+            print(f"❌ Error en la migración en segundo plano (se retoma en el próximo arranque): {e}")
+            db.rollback()
+        finally:
+            db.close()
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": CLAVE_LOCK_MIGRACION})
+
+tarea_migracion = None # Referencia viva a la tarea (asyncio solo guarda referencias débiles)
+
+async def migrar_en_segundo_plano():
+    # Índices y rellenos largos fuera del arranque: el backend atiende mientras tanto
+    await asyncio.to_thread(migrar, asyncio.get_running_loop())
+
+# --- MIGRACIÓN: TimescaleDB para `lecturas` ---
+def configurar_timescale():
+    """
+    Convierte `lecturas` en hypertable particionada por `ts` (idempotente) y activa la
+    compresión nativa segmentada por `id_sensor` para chunks de más de LECTURAS_COMPRIMIR_DIAS.
+    Si la extensión no está disponible seguimos con la tabla común y el DELETE clásico.
+    """
+    global TIMESCALE_ACTIVO
+    try:
+        with engine.begin() as conn:
+            ext = conn.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'")).first()
+            if not ext:
+                print("ℹ️ TimescaleDB no disponible: `lecturas` queda como tabla común.")
+                return
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS timescaledb"))
+            conn.execute(text(
+                "SELECT create_hypertable('lecturas', 'ts', chunk_time_interval => CAST(:chunk AS interval), "
+                "if_not_exists => TRUE, migrate_data => TRUE)"
+            ), {"chunk": f"{LECTURAS_CHUNK_HORAS} hours"})
+            comprimida = conn.execute(text(
+                "SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = 'lecturas'"
+            )).scalar()
+            if not comprimida: # No se puede re-configurar si ya hay chunks comprimidos
+                conn.execute(text(
+                    "ALTER TABLE lecturas SET (timescaledb.compress, "
+                    "timescaledb.compress_segmentby = 'id_sensor', timescaledb.compress_orderby = 'ts DESC')"
+                ))
+            conn.execute(text(
+                "SELECT add_compression_policy('lecturas', CAST(:edad AS interval), if_not_exists => TRUE)"
+            ), {"edad": f"{LECTURAS_COMPRIMIR_DIAS} days"})
+        TIMESCALE_ACTIVO = True
+        print(f"⏱️ TimescaleDB activo: `lecturas` hypertable (compresión > {LECTURAS_COMPRIMIR_DIAS} días).")
+    except Exception as e:
+        print(f"⚠️ No se pudo configurar TimescaleDB, se usa tabla común: {e}")
+
 # --- 6. Inicialización App ---
 app = FastAPI(title="HI-SENS API")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins='*',
-    logger=True,          # Para ver qué pasa dentro de SocketIO
-    engineio_logger=True, # Para ver la conexión a bajo nivel
+    logger=SOCKETIO_LOGS,          # Para ver qué pasa dentro de SocketIO (loguea cada paquete)
+    engineio_logger=SOCKETIO_LOGS, # Para ver la conexión a bajo nivel
     ping_timeout=60,      # Esperar hasta 60s antes de desconectar (Paciencia)
     ping_interval=25,     # Preguntar "¿Estás ahí?" cada 25s
     allow_eio3=True       # Habilitar compatibilidad con versiones antiguas (Arduino/ESP32)
@@ -420,11 +1705,338 @@ app.mount("/web", StaticFiles(directory="web"), name="web")
 # Scheduler (Planificador)
 scheduler = AsyncIOScheduler()
 
+# --- MÉTRICAS (Prometheus en /metrics) ---
+M_HTTP_DURACION = Histogram("hisens_http_duracion_segundos", "Duración de requests HTTP (hasta el último byte)", ["metodo", "ruta", "codigo"])
+M_LECTURAS = Counter("hisens_lecturas_total", "Lecturas ingeridas", ["nodo", "area"])
+M_ALARMAS = Counter("hisens_alarmas_total", "Transiciones del motor de alarmas", ["tipo"])
+M_POOL_CHECKOUTS = Counter("hisens_db_pool_checkouts_total", "Conexiones tomadas del pool", ["motor"])
+M_POOL_ESPERA = Histogram("hisens_db_pool_espera_segundos", "Espera para obtener una conexión del pool", ["motor"], buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 30))
+M_JOB_DURACION = Histogram("hisens_job_duracion_segundos", "Duración de tareas programadas", ["job"], buckets=(.01, .1, .5, 1, 5, 30, 60, 300, 1800))
+sockets_activos = set() # sids de Socket.IO aceptados (dashboards y nodos)
+sockets_nodos = set()   # sids autenticados con la API key: los únicos que pueden enviar 'dato_sensor'
+
+class MedirRequests:
+    """Middleware ASGI: latencia por ruta (plantilla, no path concreto) incluyendo respuestas en streaming."""
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        codigo = [500]
+        async def send_medido(msg):
+            if msg["type"] == "http.response.start": codigo[0] = msg["status"]
+            await send(msg)
+        try: await self.app(scope, receive, send_medido)
+        finally:
+            # Montajes (estáticos, Socket.IO) por prefijo: la cardinalidad de `ruta` queda acotada
+            ruta = getattr(scope.get("route"), "path", None) or next((p for p in ("/web", "/socket.io") if scope["path"].startswith(p)), "sin_ruta")
+            M_HTTP_DURACION.labels(scope["method"], ruta, str(codigo[0])).observe(time.perf_counter() - inicio)
+
+app.add_middleware(MedirRequests)
+
+def instrumentar_pool(motor: str, pool):
+    # Checkouts por evento; la espera se mide envolviendo pool.connect (incluye abrir conexiones nuevas)
+    event.listen(pool, "checkout", lambda *a: M_POOL_CHECKOUTS.labels(motor).inc())
+    conectar = pool.connect
+    def conectar_medido():
+        inicio = time.perf_counter()
+        try: return conectar()
+        finally: M_POOL_ESPERA.labels(motor).observe(time.perf_counter() - inicio)
+    pool.connect = conectar_medido
+
+instrumentar_pool("sync", engine.pool)
+instrumentar_pool("async", async_engine.sync_engine.pool)
+
+def contar_ingesta(lecturas: List[LecturaRequest], alarmas: list):
+    por_nodo = {}
+    for l in lecturas: por_nodo[l.id_nodo] = por_nodo.get(l.id_nodo, 0) + 1
+    for nid, n in por_nodo.items():
+        nodo = registro.nodo(nid)
+        M_LECTURAS.labels(nid, (nodo.area if nodo else None) or "-").inc(n)
+    for _, tipo, _ in alarmas: M_ALARMAS.labels(tipo).inc()
+
+def medir_job(nombre: str, fn):
+    # Las funciones sync siguen corriendo en un hilo, como las ejecutaba APScheduler
+    async def envoltura():
+        inicio = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(fn): await fn()
+            else: await asyncio.to_thread(fn)
+        finally:
+            M_JOB_DURACION.labels(nombre).observe(time.perf_counter() - inicio)
+    return envoltura
+
+class ColectorHisens(Collector):
+    """Lee al momento del scrape los contadores que ya llevan los componentes en memoria."""
+    def collect(self):
+        b = buffer_lecturas.estado()
+        yield GaugeMetricFamily("hisens_buffer_filas", "Lecturas esperando en el buffer de ingesta", value=b["profundidad"])
+        yield CounterMetricFamily("hisens_buffer_volcadas", "Lecturas volcadas por el buffer", value=b["total_filas"])
+        yield CounterMetricFamily("hisens_buffer_rechazadas", "Lecturas rechazadas con buffer lleno", value=b["rechazadas"])
+        yield CounterMetricFamily("hisens_buffer_descartadas", "Lecturas descartadas por error de datos al volcar", value=b["descartadas"])
+
+        e = despachador_emails.estado()
+        emails = CounterMetricFamily("hisens_emails", "Emails por resultado", labels=["resultado"])
+        for r in ["encolados", "enviados", "fallidos", "reintentos", "descartados_cola", "descartados_limite", "descartados_limite_transaccional", "digests"]: emails.add_metric([r], e[r])
+        yield emails
+        yield GaugeMetricFamily("hisens_emails_cola", "Emails esperando envío", value=e["profundidad"])
+
+        clientes = GaugeMetricFamily("hisens_socketio_clientes", "Sockets conectados", labels=["tipo"])
+        clientes.add_metric(["dashboard"], len(difusor_salas.sesiones))
+        clientes.add_metric(["nodo"], len(sockets_activos) - len(difusor_salas.sesiones))
+        yield clientes
+        yield CounterMetricFamily("hisens_socketio_frames", "Frames 'lecturas' emitidos (uno por sala por tick)", value=difusor_salas.total_frames)
+        yield CounterMetricFamily("hisens_socketio_sensores_emitidos", "Sensores enviados dentro de frames", value=difusor_salas.total_sensores)
+
+        yield GaugeMetricFamily("hisens_sensores_desconectados", "Sensores desconectados según la vigilancia", value=len(vigilante_conexiones.desconectados))
+        conexiones = CounterMetricFamily("hisens_conexion_transiciones", "Cruces del timeout de desconexión", labels=["tipo"])
+        conexiones.add_metric(["DESCONECTADO"], vigilante_conexiones.total_desconexiones)
+        conexiones.add_metric(["RECONECTADO"], vigilante_conexiones.total_reconexiones)
+        yield conexiones
+
+        pool = GaugeMetricFamily("hisens_db_pool_conexiones", "Conexiones del pool por estado", labels=["motor", "estado"])
+        for motor, p in [("sync", engine.pool), ("async", async_engine.sync_engine.pool)]:
+            pool.add_metric([motor, "en_uso"], p.checkedout())
+            pool.add_metric([motor, "libres"], p.checkedin())
+            pool.add_metric([motor, "overflow"], max(0, p.overflow()))
+        yield pool
+
+        c = pool_contrasenas.estado()
+        yield GaugeMetricFamily("hisens_bcrypt_pendientes", "Operaciones bcrypt en cola o en curso", value=c["pendientes"])
+        yield CounterMetricFamily("hisens_bcrypt_rechazadas", "Operaciones bcrypt rechazadas (503)", value=c["rechazadas"])
+        principales = CounterMetricFamily("hisens_principales_cache", "Consultas a la caché de usuarios autenticados", labels=["resultado"])
+        principales.add_metric(["acierto"], cache_principales.aciertos)
+        principales.add_metric(["fallo"], cache_principales.fallos)
+        yield principales
+
+REGISTRY.register(ColectorHisens())
+
+# --- PERFIL SQL POR REQUEST (PERFIL_SQL=true) ---
+perfil_request = contextvars.ContextVar("perfil_request", default=None)
+historial_perfiles = deque(maxlen=PERFIL_SQL_HISTORIAL)
+
+def _origen_python():
+    # Últimos frames de este módulo antes de entrar a SQLAlchemy: quién disparó la consulta
+    frames = [f for f in traceback.extract_stack()[:-3] if f.filename == __file__]
+    return [f"main.py:{f.lineno} {f.name}" for f in frames[-3:]]
+
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    if perfil_request.get() is not None: context._perfil_inicio = time.perf_counter()
+
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    perfil = perfil_request.get()
+    if perfil is None or not hasattr(context, "_perfil_inicio"): return
+    ms = (time.perf_counter() - context._perfil_inicio) * 1000
+    perfil["consultas"] += 1
+    perfil["db_ms"] += ms
+    veces = perfil["sentencias"].get(statement, 0) + 1
+    perfil["sentencias"][statement] = veces
+    # Stacks solo de requests lentos: la sentencia que lo vuelve lento y las que corren después de cruzar el umbral
+    if PERFIL_SQL_STACKS and statement not in perfil["origenes"]:
+        if ms >= PERFIL_SQL_LENTO_MS or (time.perf_counter() - perfil["inicio"]) * 1000 >= PERFIL_SQL_LENTO_MS:
+            perfil["origenes"][statement] = _origen_python()
+    perfil["tiempos"].append((ms, statement))
+
+def registrar_perfil(scope, perfil: dict, codigo: int, bytes_respuesta: int, total_ms: float):
+    ruta = getattr(scope.get("route"), "path", None) or scope["path"]
+    repetidas = sorted(((n, st) for st, n in perfil["sentencias"].items() if n >= PERFIL_SQL_REPETIDAS), reverse=True)
+    historial_perfiles.append({
+        "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "metodo": scope["method"], "ruta": ruta, "codigo": codigo,
+        "consultas": perfil["consultas"], "db_ms": round(perfil["db_ms"], 2), "total_ms": round(total_ms, 2),
+        "bytes": bytes_respuesta, "lento": total_ms >= PERFIL_SQL_LENTO_MS,
+        "lentas": [{"ms": round(ms, 2), "sql": st[:500], "origen": perfil["origenes"].get(st)} for ms, st in heapq.nlargest(PERFIL_SQL_LENTAS, perfil["tiempos"])],
+        "repetidas": [{"veces": n, "sql": st[:500], "origen": perfil["origenes"].get(st)} for n, st in repetidas[:5]]
+    })
+    if repetidas: print(f"🐢 Posible N+1 en {scope['method']} {ruta}: la misma consulta {repetidas[0][0]} veces")
+
+def analizar_rutas():
+    # Una ruta es sospechosa si repite una sentencia muchas veces en un request, o si su cantidad de
+    # consultas crece con el tamaño de la respuesta (correlación alta entre requests de la misma ruta)
+    por_ruta = {}
+    for p in historial_perfiles: por_ruta.setdefault((p["metodo"], p["ruta"]), []).append(p)
+    resultado = []
+    for (metodo, ruta), perfiles in por_ruta.items():
+        consultas = np.array([p["consultas"] for p in perfiles], dtype=float)
+        tamanos = np.array([p["bytes"] for p in perfiles], dtype=float)
+        correlacion = None
+        if len(perfiles) >= 5 and consultas.std() > 0 and tamanos.std() > 0:
+            correlacion = round(float(np.corrcoef(tamanos, consultas)[0, 1]), 3)
+        max_repeticiones = max((r["veces"] for p in perfiles for r in p["repetidas"]), default=0)
+        resultado.append({
+            "metodo": metodo, "ruta": ruta, "requests": len(perfiles),
+            "consultas_min": int(consultas.min()), "consultas_max": int(consultas.max()),
+            "db_ms_promedio": round(float(np.mean([p["db_ms"] for p in perfiles])), 2),
+            "correlacion_consultas_tamano": correlacion,
+            "max_repeticiones": max_repeticiones,
+            "sospechosa": (correlacion is not None and correlacion > 0.8) or max_repeticiones >= PERFIL_SQL_REPETIDAS
+        })
+    return sorted(resultado, key=lambda r: (not r["sospechosa"], -r["consultas_max"]))
+
+class PerfilSQL:
+    """Middleware ASGI: cuenta consultas y tiempo de BD del request (headers X-SQL-*) y lo guarda en el historial."""
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        perfil = {"consultas": 0, "db_ms": 0.0, "sentencias": {}, "origenes": {}, "tiempos": [], "inicio": inicio}
+        token = perfil_request.set(perfil)
+        codigo, bytes_respuesta = [500], [0]
+        async def send_perfil(msg):
+            if msg["type"] == "http.response.start":
+                codigo[0] = msg["status"]
+                # En respuestas en streaming solo cuenta lo ejecutado hasta acá (el total queda en el historial)
+                msg = {**msg, "headers": list(msg.get("headers", [])) + [
+                    (b"x-sql-consultas", str(perfil["consultas"]).encode()),
+                    (b"x-sql-tiempo-ms", f"{perfil['db_ms']:.1f}".encode())
+                ]}
+            elif msg["type"] == "http.response.body":
+                bytes_respuesta[0] += len(msg.get("body", b""))
+            await send(msg)
+        try: await self.app(scope, receive, send_perfil)
+        finally:
+            perfil_request.reset(token)
+            registrar_perfil(scope, perfil, codigo[0], bytes_respuesta[0], (time.perf_counter() - inicio) * 1000)
+
+if PERFIL_SQL:
+    for motor in (engine, async_engine.sync_engine):
+        event.listen(motor, "before_cursor_execute", _antes_de_consulta)
+        event.listen(motor, "after_cursor_execute", _despues_de_consulta)
+    app.add_middleware(PerfilSQL)
+    print("🔬 Perfil SQL por request activo (ver /api/perfil/sql).")
+
+# --- CAPTURA DE INGESTA (record & replay) ---
+RUTAS_CAPTURA = {"/api/lectura": "l", "/api/lectura/batch": "b", "/api/telemetria": "t"}
+
+class CapturaIngesta:
+    """
+    Guarda los requests de ingesta tal como llegaron (JSON por línea: instante, ruta, cuerpo,
+    status y duración) para reproducirlos después con reproducir_captura.py. El middleware solo
+    encola; una tarea escribe en tandas desde un hilo y rota el archivo por tamaño.
+    No se guarda la API key ni ningún header.
+    """
+    def __init__(self, directorio: str, max_mb: int, archivos: int, max_cola: int):
+        self.archivo = os.path.join(directorio, f"ingesta-{os.getpid()}.jsonl")
+        self.max_bytes = max_mb * 1024 * 1024
+        self.archivos = archivos
+        self.max_cola = max_cola
+        self.cola = deque()
+        self.tarea = None
+        self.escritos = 0
+        self.descartados = 0
+        self.rotaciones = 0
+
+    def registrar(self, ts: float, ruta: str, cuerpo: bytes, codigo: int, ms: float):
+        if len(self.cola) >= self.max_cola:
+            self.descartados += 1
+            return
+        try: datos = json.loads(cuerpo)
+        except ValueError: datos = cuerpo.decode("utf-8", "replace") # Se reproduce tal cual (p.ej. JSON inválido -> 422)
+        self.cola.append(json.dumps({"t": round(ts, 4), "r": RUTAS_CAPTURA[ruta], "b": datos, "s": codigo, "ms": round(ms, 2)}, separators=(",", ":")))
+
+    def _escribir(self, lineas: list):
+        os.makedirs(os.path.dirname(self.archivo) or ".", exist_ok=True)
+        if os.path.exists(self.archivo) and os.path.getsize(self.archivo) >= self.max_bytes:
+            for i in range(self.archivos - 1, 0, -1):
+                if os.path.exists(f"{self.archivo}.{i}"): os.replace(f"{self.archivo}.{i}", f"{self.archivo}.{i + 1}")
+            os.replace(self.archivo, f"{self.archivo}.1")
+            self.rotaciones += 1
+        with open(self.archivo, "a", encoding="utf-8") as f: f.write("\n".join(lineas) + "\n")
+
+    async def vaciar(self):
+        if not self.cola: return
+        lineas = [self.cola.popleft() for _ in range(len(self.cola))]
+        try:
+            await asyncio.to_thread(self._escribir, lineas)
+            self.escritos += len(lineas)
+        except Exception as e:
+            self.descartados += len(lineas)
+            print(f"❌ Captura de ingesta: no se pudo escribir {self.archivo}: {e}")
+
+    async def _ciclo(self):
+        while True:
+            await asyncio.sleep(1)
+            await self.vaciar()
+
+    def iniciar(self):
+        if self.tarea is None:
+            self.tarea = asyncio.create_task(self._ciclo())
+            print(f"🎙️ Capturando la ingesta en {self.archivo}")
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            self.tarea = None
+        await self.vaciar()
+
+    def estado(self):
+        return {"activa": CAPTURA_INGESTA, "archivo": self.archivo, "pendientes": len(self.cola), "escritos": self.escritos, "descartados": self.descartados, "rotaciones": self.rotaciones}
+
+captura_ingesta = CapturaIngesta(CAPTURA_DIR, CAPTURA_MAX_MB, CAPTURA_ARCHIVOS, CAPTURA_MAX_COLA)
+
+class CapturarIngesta:
+    """Middleware ASGI: copia el cuerpo de los POST de ingesta y lo registra con su resultado."""
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in RUTAS_CAPTURA:
+            return await self.app(scope, receive, send)
+        ts, inicio = time.time(), time.perf_counter()
+        partes, codigo = [], [500]
+        async def receive_copia():
+            msg = await receive()
+            if msg["type"] == "http.request": partes.append(msg.get("body", b""))
+            return msg
+        async def send_codigo(msg):
+            if msg["type"] == "http.response.start": codigo[0] = msg["status"]
+            await send(msg)
+        try: await self.app(scope, receive_copia, send_codigo)
+        finally: captura_ingesta.registrar(ts, scope["path"], b"".join(partes), codigo[0], (time.perf_counter() - inicio) * 1000)
+
+if CAPTURA_INGESTA: app.add_middleware(CapturarIngesta)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}": raise HTTPException(401, "Token de métricas inválido")
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+@sio.event
+async def connect(sid, environ, auth):
+    # Dashboards: traen el JWT en `auth` y entran a las salas de sus áreas.
+    # Nodos (solo envían 'dato_sensor'): traen la API key en `auth` o en X-API-Key; no reciben difusión.
+    token = auth.get("token") if isinstance(auth, dict) else None
+    if not token:
+        clave = (auth.get("api_key") if isinstance(auth, dict) else None) or environ.get("HTTP_X_API_KEY")
+        if clave != API_KEY_SECRET and not TELEMETRIA_SIN_CLAVE: raise socketio.exceptions.ConnectionRefusedError("X-API-Key inválida")
+        sockets_activos.add(sid)
+        sockets_nodos.add(sid)
+        return
+    try: username = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError: raise socketio.exceptions.ConnectionRefusedError("Credenciales inválidas")
+    # Caché de principales o asyncpg: una ola de reconexiones no debe bloquear el event loop
+    user = await principal_async(username) if username else None
+    if user is None or not user.activo: raise socketio.exceptions.ConnectionRefusedError("Credenciales inválidas")
+    sockets_activos.add(sid)
+    await difusor_salas.conectar(sid, username, user.rol, list(user.suscripciones))
+
+@sio.event
+async def disconnect(sid, *args):
+    sockets_activos.discard(sid)
+    sockets_nodos.discard(sid)
+    difusor_salas.desconectar(sid)
+
+@sio.on('sincronizar')
+async def sincronizar(sid, data):
+    # El dashboard lo pide en cada (re)conexión con el último {epoca, seq} que vio; la respuesta va por ack
+    data = data if isinstance(data, dict) else {}
+    return difusor_salas.sincronizar(sid, data.get("epoca"), data.get("seq"))
+
 @sio.on('dato_sensor')
 async def handle_sensor_data(sid, data):
-    # 1. IMPRIMIR LO QUE LLEGA (Para ver si el formato es correcto)
-    print(f"📡 DEBUG - Recibido del ESP32: {data}")
-
+    # Sin logs por frame (con muchos nodos saturan stdout): el volumen se ve en /metrics
+    # y el contenido de los paquetes con SOCKETIO_LOGS=true
+    if sid not in sockets_nodos: return # Solo nodos autenticados con la API key (los dashboards no escriben)
     try:
         # Intentamos procesar (Sea lista o diccionario)
         lista_sensores = []
@@ -437,23 +2049,20 @@ async def handle_sensor_data(sid, data):
             print(f"⚠️ Formato no reconocido: {type(data)}")
             return # Salimos suavemente sin romper nada
 
-        # Procesamos cada sensor
+        # PARCHE DE SEGURIDAD: Rellenar datos faltantes
         for item in lista_sensores:
-            # PARCHE DE SEGURIDAD: Rellenar datos faltantes
+            if not isinstance(item, dict): continue
             if "id_nodo" not in item: 
                 item["id_nodo"] = "ESP32-GENERICO"
             if "ubicacion" not in item:
                 item["ubicacion"] = "Desconocida"
 
-            # AQUÍ ES DONDE SOLÍA EXPLOTAR
-            # Imprimimos antes de validar para saber dónde falla
-            print(f"🔄 Procesando sensor: {item.get('id_sensor', 'SIN ID')}")
-
-            # --- AQUÍ LLAMAS A TU LÓGICA DE BASE DE DATOS ---
-            # await guardar_dato(item) 
-            # (Asegúrate de que 'guardar_dato' también tenga try/except si es compleja)
-
-            print(f"✅ Guardado OK: {item.get('id_sensor')}")
+        # Mismo pipeline que /api/lectura: validación, INSERT del frame completo y alarmas
+        # (los dashboards lo reciben en el próximo frame de su sala).
+        # Acá no hay request de FastAPI: abrimos sesión propia.
+        async with AsyncSessionLocal() as db:
+            resumen = await ingerir_telemetria(db, lista_sensores)
+        if resumen["guardadas"] < resumen["recibidas"]: print(f"⚠️ Frame de {sid}: {resumen['guardadas']}/{resumen['recibidas']} lecturas válidas")
 
     except Exception as e:
         # 🛡️ CHALECO ANTIBALAS
@@ -466,20 +2075,17 @@ async def handle_sensor_data(sid, data):
 
 # --- EL BUZÓN HTTP (NUEVO) ---
 @app.post("/api/telemetria")
-async def recibir_datos_esp32(datos: list[dict] = Body(...)):
-    print(f"📡 HTTP POST Recibido: {datos}")
+async def recibir_datos_esp32(datos: list[dict] = Body(...), db: AsyncSession = Depends(get_async_db), k: str = Depends(get_api_key_telemetria)):
+    if len(datos) > MAX_LOTE_LECTURAS:
+        raise HTTPException(413, f"Máximo {MAX_LOTE_LECTURAS} lecturas por lote")
     
     try:
-        # 1. Reenviar inmediatamente al Dashboard (Frontend)
-        # Esto hace que se vea en tiempo real
-        if sio: # Verificar si sio esta inicializado
-            await sio.emit('dato_sensor', datos)
-        
-        # 2. (Opcional) Aquí guardarías en base de datos
-        # await guardar_en_db(datos)
-        
-        return {"status": "ok", "mensaje": "Datos recibidos y reenviados"}
+        # Guardar el frame completo (validación, INSERT único y alarmas, como /api/lectura).
+        # El Dashboard lo recibe en tiempo real en el próximo frame de su sala.
+        resumen = await ingerir_telemetria(db, datos)
+        return {"status": "ok", "mensaje": "Datos recibidos y reenviados", **resumen}
         
+    except HTTPException: raise
     except Exception as e:
         print(f"❌ Error procesando HTTP: {e}")
         return {"status": "error", "detalle": str(e)}
@@ -524,7 +2130,8 @@ def seed_database(db: Session):
             Configuracion(id="silencio_alarmas", valor="60"),
             Configuracion(id="retencion_conexiones", valor="90"),
             Configuracion(id="retencion_auditoria", valor="365"),
-            Configuracion(id="retencion_accesos", valor="180")
+            Configuracion(id="retencion_accesos", valor="180"),
+            Configuracion(id="retencion_lecturas", valor="90")
         ]
         db.add_all(default_config)
 
@@ -547,41 +2154,63 @@ async def on_startup():
     try:
         engine.connect()
         Base.metadata.create_all(bind=engine)
+        configurar_timescale()
         db = SessionLocal()
         seed_database(db)
+        registro.cargar(db)
+        cache_config.cargar(db)
+        motor_alarmas.cargar(db)
+        cargar_ultimas(db)
+        preparar_rellenos(db)
+        vigilante_conexiones.cargar(db)
         db.close()
         
         # INICIAR SCHEDULER
-        scheduler.add_job(ejecutar_limpieza_diaria, 'interval', hours=24)
+        scheduler.add_job(medir_job("limpieza_diaria", ejecutar_limpieza_diaria), 'interval', hours=24)
+        # Red de seguridad por si se pierde un NOTIFY (p.ej. reconexión de la BD)
+        scheduler.add_job(medir_job("recargar_config", cache_config.recargar), 'interval', minutes=5)
         scheduler.start()
         print("🕒 Planificador de tareas iniciado.")
+
+        if INGESTA_ASINCRONA: buffer_lecturas.iniciar()
+        despachador_emails.iniciar()
+        vigilante_conexiones.iniciar()
+        difusor_salas.iniciar()
+        if CAPTURA_INGESTA: captura_ingesta.iniciar()
+        global tarea_migracion
+        tarea_migracion = asyncio.create_task(migrar_en_segundo_plano())
+
+        try: await escuchar_cambios_config()
+        except Exception as e: print(f"⚠️ Sin LISTEN/NOTIFY, la configuración se recarga cada 5 minutos: {e}")
         
     except Exception as e: print(f"Error startup: {e}")
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Volcar lo que quede en el buffer antes de cerrar el proceso
+    if INGESTA_ASINCRONA: await buffer_lecturas.detener()
+    await despachador_emails.detener()
+    await vigilante_conexiones.detener()
+    await difusor_salas.detener()
+    if CAPTURA_INGESTA: await captura_ingesta.detener()
+    cerrar_escucha_config()
+    await async_engine.dispose()
+
 
 # --- ENDPOINTS ---
 
 @app.get("/api/usuarios/me", response_model=User)
 def read_users_me(current_user: Annotated[User, Depends(get_current_active_user)]):
-    lista_areas = [s.area for s in current_user.suscripciones]
-    return User(
-        username=current_user.username,
-        nombre_completo=current_user.nombre_completo,
-        email=current_user.email,
-        rol=current_user.rol,
-        puesto=current_user.puesto,
-        activo=current_user.activo,
-        suscripciones=lista_areas
-    )
+    return current_user
 
 @app.post("/api/token", response_model=TokenResponse)
-async def login(request: Request, form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)):
-    user = get_user(db, form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(request: Request, form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(Usuario).where(Usuario.username == form_data.username))).scalar_one_or_none()
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         try:
             ip = request.client.host
             db.add(Evento(tipo_evento="LOGIN_FALLIDO", username=form_data.username if user else None, detalle=f"IP: {ip}"))
-            db.commit()
+            await db.commit()
         except: pass
         raise HTTPException(401, "Credenciales inválidas")
     
@@ -589,7 +2218,7 @@ async def login(request: Request, form_data: Annotated[OAuth2PasswordRequestForm
     try:
         ip = request.client.host
         db.add(Evento(tipo_evento="LOGIN_EXITOSO", username=user.username, detalle=f"IP: {ip}"))
-        db.commit()
+        await db.commit()
     except: pass
     
     return {"access_token": token, "token_type": "bearer", "must_reset": user.force_password_change, "rol": user.rol}
@@ -653,6 +2282,8 @@ def update_user(username: str, d: UserUpdateRequest, u: Annotated[User, Depends(
         db.rollback(); raise HTTPException(500, f"Error: {e}")
     
     lista_areas = [s.area for s in db_user.suscripciones]
+    cache_principales.invalidar(db_user.username)
+    difusor_salas.reasignar(db_user.username, db_user.rol if db_user.activo else None, lista_areas)
     return User(
         username=db_user.username, nombre_completo=db_user.nombre_completo, email=db_user.email,
         rol=db_user.rol, puesto=db_user.puesto, activo=db_user.activo, suscripciones=lista_areas
@@ -668,7 +2299,7 @@ def get_all_users(u: Annotated[User, Depends(get_current_admin_user)], db: Sessi
 
 @app.post("/api/usuarios/borrar", status_code=204)
 def delete_user_verified(req: UserDeleteRequest, u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db)):
-    if not verify_password(req.admin_password, u.hashed_password): raise HTTPException(401, "Pass incorrecta")
+    if not verify_password(req.admin_password, get_user(db, u.username).hashed_password): raise HTTPException(401, "Pass incorrecta")
     if u.username == req.username_to_delete: raise HTTPException(400, "No automorición")
     db_user = get_user(db, req.username_to_delete)
     if not db_user: raise HTTPException(404, "No encontrado")
@@ -676,12 +2307,14 @@ def delete_user_verified(req: UserDeleteRequest, u: Annotated[User, Depends(get_
     db.delete(db_user)
     db.add(Evento(tipo_evento="BORRAR_USUARIO", username=u.username, detalle=f"Usuario {req.username_to_delete} eliminado"))
     db.commit()
+    cache_principales.invalidar(req.username_to_delete)
+    difusor_salas.reasignar(req.username_to_delete, None, [])
 
 @app.get("/api/nodos/all", response_model=List[NodoInfo])
 def get_all_nodos(u: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db)):
     query = db.query(Nodo).options(joinedload(Nodo.sensores))
     if u.rol != "Admin":
-        areas_permitidas = [s.area for s in u.suscripciones]
+        areas_permitidas = u.suscripciones
         if not areas_permitidas: return []
         query = query.filter(Nodo.area.in_(areas_permitidas))
     return query.all()
@@ -692,6 +2325,7 @@ def create_node(d: NodoCreate, u: Annotated[User, Depends(get_current_supervisor
     db.add(Nodo(id=d.id, area=d.area, direccion=d.direccion, piso=d.piso))
     db.add(Evento(tipo_evento="CREAR_NODO", username=u.username, detalle=f"Nodo {d.id} creado"))
     db.commit()
+    registro.refrescar_nodo(db, d.id)
     return {"status":"ok"}
 
 @app.put("/api/nodos/editar/{nid}")
@@ -701,6 +2335,7 @@ def update_node(nid: str, d: NodoUpdate, u: Annotated[User, Depends(get_current_
     n.area, n.direccion, n.piso = d.area, d.direccion, d.piso
     db.add(Evento(tipo_evento="EDITAR_NODO", username=u.username, detalle=f"Nodo {nid} editado"))
     db.commit()
+    registro.guardar_nodo(n)
     return n
 
 @app.post("/api/sensores/crear")
@@ -711,6 +2346,7 @@ def create_sensor(d: SensorCreate, u: Annotated[User, Depends(get_current_superv
     db.add(Sensor(id=d.id, id_nodo=d.id_nodo, nombre_tarjeta=d.nombre_tarjeta, tipo=d.tipo, unidad=d.unidad, limite_alto=30, limite_bajo=0))
     db.add(Evento(tipo_evento="CREAR_SENSOR", username=u.username, detalle=f"Sensor {d.id} creado"))
     db.commit()
+    registro.refrescar_sensor(db, d.id)
     return {"status":"ok"}
 
 @app.post("/api/sensor/config/{sid}")
@@ -720,16 +2356,19 @@ def update_sensor(sid: str, c: SensorConfig, u: Annotated[User, Depends(get_curr
     s.limite_alto, s.limite_bajo, s.visible = c.limite_alto, c.limite_bajo, c.visible
     db.add(Evento(tipo_evento="CAMBIO_LIMITE", username=u.username, detalle=f"Sensor {sid} configurado"))
     db.commit()
+    registro.guardar_sensor(s)
     return {"status":"ok"}
 
 @app.get("/api/sensores/estado-actual", response_model=List[SensorEstado])
 def get_status(u: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db)):
-    config_timeout = db.query(Configuracion).filter(Configuracion.id == "timeout_desconexion").first()
-    timeout_limite = int(config_timeout.valor) if config_timeout and config_timeout.valor.isdigit() else 300
+    timeout_limite = cache_config.conf.timeout_desconexion
     
-    query = text("SELECT DISTINCT ON (id_sensor) id_sensor, valor, ts FROM lecturas ORDER BY id_sensor, ts DESC")
-    raw = db.execute(query).fetchall()
-    ultimos_datos = {row[0]: {"valor": row[1], "ts": row[2]} for row in raw}
+    # O(cantidad de sensores): tabla `ultima_lectura` (vale para todos los workers) +
+    # el espejo en memoria de este proceso, que puede ir por delante del buffer de ingesta
+    ultimos_datos = {u.id_sensor: {"valor": u.valor, "ts": u.ts} for u in db.query(UltimaLectura).all()}
+    for sid, dato in list(ultimas_lecturas.items()):
+        actual = ultimos_datos.get(sid)
+        if actual is None or actual["ts"] is None or actual["ts"] < dato["ts"]: ultimos_datos[sid] = dato
     
     sensores = db.query(Sensor).options(joinedload(Sensor.nodo)).all()
     estado_final = []
@@ -749,83 +2388,333 @@ def get_status(u: Annotated[User, Depends(get_current_active_user)], db: Session
         estado_final.append(SensorEstado(id=s.id, valor=valor_actual, bateria=s.nodo.bateria, conectado=esta_conectado))
     return estado_final
 
+def elegir_resolucion(db: Session, sid: str, desde: datetime.datetime, hasta: datetime.datetime, max_puntos: int):
+    """
+    Devuelve el nivel más fino que entra en el presupuesto de puntos: None (datos crudos),
+    Lectura1m o Lectura1h. La cantidad de filas crudas sale del rollup de 1 minuto (barato).
+    """
+    crudas = db.query(func.coalesce(func.sum(Lectura1m.cantidad), 0)).filter(
+        Lectura1m.id_sensor == sid, Lectura1m.bucket >= truncar_ts(desde, 60), Lectura1m.bucket < hasta
+    ).scalar()
+    if crudas <= max_puntos: return None
+    segundos_rango = (hasta - desde).total_seconds()
+    for modelo, segundos in ROLLUPS:
+        if segundos_rango / segundos <= max_puntos: return modelo
+    return ROLLUPS[-1][0]
+
+# --- REDUCCIÓN DE PUNTOS PARA GRÁFICOS (NumPy, sin bucles por punto) ---
+def _primero_por_bucket(candidatos: np.ndarray, bucket: np.ndarray):
+    # Índice del primer candidato de cada bucket (bucket viene ordenado)
+    _, primeros = np.unique(bucket[candidatos], return_index=True)
+    return candidatos[primeros]
+
+def indices_lttb(x: np.ndarray, y: np.ndarray, n: int):
+    """
+    Largest-Triangle-Three-Buckets vectorizado. Conserva el primer y último punto y elige en
+    cada bucket el punto que forma el triángulo de mayor área con el promedio del bucket
+    anterior y del siguiente (variante sin dependencia secuencial, apta para NumPy).
+    """
+    total = len(x)
+    if n >= total or n < 3: return np.arange(total)
+    bordes = np.linspace(1, total - 1, n - 1).astype(np.int64) # n-2 buckets interiores
+    inicios = bordes[:-1]
+    cuentas = np.diff(bordes)
+    medias_x = np.add.reduceat(x[:total - 1], inicios) / cuentas
+    medias_y = np.add.reduceat(y[:total - 1], inicios) / cuentas
+    ax = np.concatenate(([x[0]], medias_x[:-1])); ay = np.concatenate(([y[0]], medias_y[:-1]))
+    cx = np.concatenate((medias_x[1:], [x[-1]])); cy = np.concatenate((medias_y[1:], [y[-1]]))
+
+    bucket = np.repeat(np.arange(n - 2), cuentas)
+    px, py = x[1:total - 1], y[1:total - 1]
+    area = np.abs((ax[bucket] - cx[bucket]) * (py - ay[bucket]) - (ax[bucket] - px) * (cy[bucket] - ay[bucket]))
+    maximos = np.maximum.reduceat(area, inicios - 1)
+    elegidos = _primero_por_bucket(np.flatnonzero(area == np.repeat(maximos, cuentas)), bucket) + 1
+    return np.concatenate(([0], elegidos, [total - 1]))
+
+def indices_minmax(y_min: np.ndarray, y_max: np.ndarray, n: int):
+    """
+    Mínimo y máximo de cada bucket (n/2 buckets): ningún pico de alarma se pierde.
+    En datos crudos y_min = y_max = valor; en rollups son las columnas minimo/maximo (el promedio aplana los picos).
+    """
+    total = len(y_min)
+    if n >= total or n < 2: return np.arange(total)
+    buckets = n // 2
+    inicios = np.linspace(0, total, buckets + 1).astype(np.int64)[:-1]
+    cuentas = np.diff(np.append(inicios, total))
+    bucket = np.repeat(np.arange(buckets), cuentas)
+    i_min = _primero_por_bucket(np.flatnonzero(y_min == np.repeat(np.minimum.reduceat(y_min, inicios), cuentas)), bucket)
+    i_max = _primero_por_bucket(np.flatnonzero(y_max == np.repeat(np.maximum.reduceat(y_max, inicios), cuentas)), bucket)
+    return np.unique(np.concatenate((i_min, i_max)))
+
+def cargar_serie(db: Session, sid: str, modelo, desde: datetime.datetime, hasta: datetime.datetime):
+    # Devuelve una matriz (epoch, valor, minimo, maximo); en datos crudos minimo/maximo = NaN
+    if modelo is None:
+        q = db.query(cast(func.extract("epoch", Lectura.ts), Float), Lectura.valor).filter(
+            Lectura.id_sensor == sid, Lectura.ts >= desde, Lectura.ts < hasta).order_by(Lectura.ts.asc())
+        datos = np.array(q.all(), dtype=np.float64).reshape(-1, 2)
+        return np.column_stack((datos, np.full((len(datos), 2), np.nan)))
+    # Desde el inicio del bucket que contiene `desde`: si no, se pierde el primer bucket parcial
+    q = db.query(cast(func.extract("epoch", modelo.bucket), Float), modelo.suma / modelo.cantidad, modelo.minimo, modelo.maximo).filter(
+        modelo.id_sensor == sid, modelo.bucket >= truncar_ts(desde, dict(ROLLUPS)[modelo]), modelo.bucket < hasta).order_by(modelo.bucket.asc())
+    return np.array(q.all(), dtype=np.float64).reshape(-1, 4)
+
 @app.get("/api/sensor/{sid}/historial", response_model=List[LecturaHistorial])
-def get_hist(sid: str, u: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db)):
-    t = datetime.datetime.now(datetime.timezone.utc) - timedelta(hours=1)
-    return db.query(Lectura).filter(Lectura.id_sensor==sid, Lectura.ts >= t).order_by(Lectura.ts.asc()).all()
+def get_hist(
+    sid: str,
+    u: Annotated[User, Depends(get_current_active_user)],
+    response: Response,
+    db: Session = Depends(get_db),
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None,
+    max_puntos: int = Query(1000, ge=10, le=20000),
+    muestreo: str = Query("lttb", pattern="^(lttb|minmax|ninguno)$")
+):
+    # Sin rango: última hora (comportamiento original del gráfico)
+    hasta = hasta or datetime.datetime.now(datetime.timezone.utc)
+    if hasta.tzinfo is None: hasta = hasta.replace(tzinfo=datetime.timezone.utc)
+    desde = desde or hasta - timedelta(hours=1)
+    if desde.tzinfo is None: desde = desde.replace(tzinfo=datetime.timezone.utc)
+    if desde >= hasta: raise HTTPException(400, "'desde' debe ser anterior a 'hasta'")
+
+    if muestreo != "ninguno":
+        # Se lee el nivel más fino con a lo sumo MUESTREO_FACTOR filas por punto pedido y se reduce a max_puntos:
+        # rangos largos salen de los rollups en vez de cargar meses de datos crudos
+        modelo = elegir_resolucion(db, sid, desde, hasta, min(max_puntos * MUESTREO_FACTOR, MAX_FILAS_MUESTREO))
+        serie = cargar_serie(db, sid, modelo, desde, hasta)
+        if len(serie) > max_puntos:
+            if muestreo == "lttb": idx = indices_lttb(serie[:, 0], serie[:, 1], max_puntos)
+            elif modelo is None: idx = indices_minmax(serie[:, 1], serie[:, 1], max_puntos)
+            else: idx = indices_minmax(serie[:, 2], serie[:, 3], max_puntos)
+            serie = serie[idx]
+        response.headers["X-Resolucion"] = modelo.__tablename__ if modelo is not None else "cruda"
+        response.headers["X-Muestreo"] = muestreo
+        return [
+            LecturaHistorial(
+                ts=datetime.datetime.fromtimestamp(f[0], tz=datetime.timezone.utc), valor=f[1],
+                minimo=None if np.isnan(f[2]) else f[2], maximo=None if np.isnan(f[3]) else f[3]
+            ) for f in serie.tolist()
+        ]
+
+    # Sin muestreo: el nivel más fino cuyo total de puntos entra en max_puntos
+    modelo = elegir_resolucion(db, sid, desde, hasta, max_puntos)
+    if modelo is None:
+        response.headers["X-Resolucion"] = "cruda"
+        return db.query(Lectura).filter(Lectura.id_sensor==sid, Lectura.ts >= desde, Lectura.ts < hasta).order_by(Lectura.ts.asc()).all()
+
+    response.headers["X-Resolucion"] = modelo.__tablename__
+    filas = db.query(modelo).filter(modelo.id_sensor==sid, modelo.bucket >= truncar_ts(desde, dict(ROLLUPS)[modelo]), modelo.bucket < hasta).order_by(modelo.bucket.asc()).all()
+    return [LecturaHistorial(ts=r.bucket, valor=r.suma / r.cantidad, minimo=r.minimo, maximo=r.maximo) for r in filas]
 
-@app.get("/api/logs/accesos", response_model=List[EventoLog])
-def logs_acc(u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, username: Optional[str]=None):
-    q = db.query(Evento).filter(Evento.tipo_evento.in_(["LOGIN_EXITOSO", "LOGIN_FALLIDO"]))
+# --- PAGINACIÓN POR KEYSET (cursor = último (ts, id) entregado) ---
+def codificar_cursor(ev: Evento):
+    return base64.urlsafe_b64encode(f"{ev.ts.isoformat()}|{ev.id}".encode()).decode()
+
+def decodificar_cursor(cursor: str):
+    try:
+        ts, id_ev = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(ts), int(id_ev)
+    except Exception:
+        raise HTTPException(400, "Cursor inválido")
+
+def paginar_eventos(q, cursor: Optional[str], limite: int):
+    # Sin OFFSET: cada página es un rango del índice (ts, id), cuesta lo mismo la primera que la milésima
+    if cursor:
+        ts, id_ev = decodificar_cursor(cursor)
+        q = q.filter(tuple_(Evento.ts, Evento.id) < tuple_(ts, id_ev))
+    filas = q.order_by(Evento.ts.desc(), Evento.id.desc()).limit(limite + 1).all()
+    siguiente = codificar_cursor(filas[limite - 1]) if len(filas) > limite else None
+    return EventoPagina(items=filas[:limite], next_cursor=siguiente)
+
+@app.get("/api/logs/accesos", response_model=EventoPagina)
+def logs_acc(u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, username: Optional[str]=None, cursor: Optional[str]=None, limite: int = Query(200, ge=1, le=1000)):
+    q = db.query(Evento).filter(Evento.tipo_evento.in_(TIPOS_ACCESO))
     if desde: q = q.filter(Evento.ts >= desde)
     if hasta: q = q.filter(Evento.ts < datetime.datetime.fromisoformat(hasta) + timedelta(days=1))
     if username and username != "todos": q = q.filter(Evento.username == username)
-    return q.order_by(Evento.ts.desc()).limit(200).all()
+    return paginar_eventos(q, cursor, limite)
 
-@app.get("/api/logs/auditoria", response_model=List[EventoLog])
-def logs_audit(u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, username: Optional[str]=None, sensor_id: Optional[str]=None):
-    q = db.query(Evento).filter(Evento.tipo_evento.notin_(["LOGIN_EXITOSO", "LOGIN_FALLIDO", "ALARMA_ALTA", "ALARMA_BAJA", "DESCONECTADO", "RECONECTADO"]))
+@app.get("/api/logs/auditoria", response_model=EventoPagina)
+def logs_audit(u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, username: Optional[str]=None, sensor_id: Optional[str]=None, cursor: Optional[str]=None, limite: int = Query(200, ge=1, le=1000)):
+    q = db.query(Evento).filter(Evento.tipo_evento.notin_(TIPOS_NO_AUDITORIA))
     if desde: q = q.filter(Evento.ts >= desde)
     if hasta: q = q.filter(Evento.ts < datetime.datetime.fromisoformat(hasta) + timedelta(days=1))
     if username and username != "todos": q = q.filter(Evento.username == username)
     if sensor_id and sensor_id != "todos": q = q.filter(Evento.id_sensor == sensor_id)
-    return q.order_by(Evento.ts.desc()).limit(200).all()
+    return paginar_eventos(q, cursor, limite)
 
-@app.get("/api/logs/alarmas", response_model=List[EventoLog])
-def logs_alarm(u: Annotated[User, Depends(get_current_tecnico_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, sensor_id: Optional[str]=None):
-    q = db.query(Evento).filter(Evento.tipo_evento.in_(["ALARMA_ALTA", "ALARMA_BAJA"]))
+@app.get("/api/logs/alarmas", response_model=EventoPagina)
+def logs_alarm(u: Annotated[User, Depends(get_current_tecnico_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, sensor_id: Optional[str]=None, cursor: Optional[str]=None, limite: int = Query(200, ge=1, le=1000)):
+    q = db.query(Evento).filter(Evento.tipo_evento.in_(TIPOS_ALARMA))
     if desde: q = q.filter(Evento.ts >= desde)
     if hasta: q = q.filter(Evento.ts < datetime.datetime.fromisoformat(hasta) + timedelta(days=1))
     if sensor_id and sensor_id != "todos": q = q.filter(Evento.id_sensor == sensor_id)
-    return q.order_by(Evento.ts.desc()).limit(200).all()
+    return paginar_eventos(q, cursor, limite)
 
-@app.get("/api/logs/conexiones", response_model=List[EventoLog])
-def logs_conn(u: Annotated[User, Depends(get_current_tecnico_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, sensor_id: Optional[str]=None):
-    q = db.query(Evento).filter(Evento.tipo_evento.in_(["DESCONECTADO", "RECONECTADO"]))
+@app.get("/api/logs/conexiones", response_model=EventoPagina)
+def logs_conn(u: Annotated[User, Depends(get_current_tecnico_user)], db: Session = Depends(get_db), desde: Optional[str]=None, hasta: Optional[str]=None, sensor_id: Optional[str]=None, cursor: Optional[str]=None, limite: int = Query(200, ge=1, le=1000)):
+    q = db.query(Evento).filter(Evento.tipo_evento.in_(TIPOS_CONEXION))
     if desde: q = q.filter(Evento.ts >= desde)
     if hasta: q = q.filter(Evento.ts < datetime.datetime.fromisoformat(hasta) + timedelta(days=1))
     if sensor_id and sensor_id != "todos": q = q.filter(Evento.id_sensor == sensor_id)
-    return q.order_by(Evento.ts.desc()).limit(200).all()
+    return paginar_eventos(q, cursor, limite)
 
 @app.get("/api/configuracion", response_model=ConfiguracionGet)
-def get_conf(u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db)):
-    items = db.query(Configuracion).all()
-    d = {i.id: i.valor for i in items}
-    return ConfiguracionGet(**d)
+def get_conf(u: Annotated[User, Depends(get_current_admin_user)]):
+    return cache_config.conf
 
 @app.put("/api/configuracion", response_model=ConfiguracionGet)
 def upd_conf(c: ConfiguracionUpdate, u: Annotated[User, Depends(get_current_admin_user)], db: Session = Depends(get_db)):
     d = c.model_dump()
+    items = {i.id: i for i in db.query(Configuracion).all()}
     for k, v in d.items():
-        val = str(v)
-        item = db.query(Configuracion).filter(Configuracion.id==k).first()
+        val = str(v) if v is not None else None
+        item = items.get(k)
         if item: item.valor = val
         else: db.add(Configuracion(id=k, valor=val))
-    return get_conf(u, db)
+    # El NOTIFY se entrega recién al confirmar la transacción: los demás workers no ven cambios a medias
+    db.execute(text("SELECT pg_notify(:canal, '')"), {"canal": CANAL_CONFIG})
+    db.commit()
+    cache_config.cargar(db)
+    return cache_config.conf
+
+class _EcoCSV:
+    # "Archivo" que devuelve lo escrito: csv.writer produce cada línea sin acumular nada en memoria
+    def write(self, valor): return valor
+
+def generar_csv_eventos(tipo_log: str, desde: Optional[datetime.datetime], hasta: Optional[datetime.datetime], sensor_id: Optional[str], username: Optional[str], filas_por_tanda: int = 1000):
+    # Sesión propia: el generador vive más que el request (la respuesta se envía mientras se lee)
+    db = SessionLocal()
+    try:
+        q = db.query(Evento.ts, Evento.tipo_evento, Evento.id_sensor, Evento.username, Evento.detalle)
+        if tipo_log == "alarmas": q = q.filter(Evento.tipo_evento.in_(TIPOS_ALARMA))
+        elif tipo_log == "conexiones": q = q.filter(Evento.tipo_evento.in_(TIPOS_CONEXION))
+        elif tipo_log == "auditoria": q = q.filter(Evento.tipo_evento.notin_(TIPOS_NO_AUDITORIA))
+        elif tipo_log == "accesos": q = q.filter(Evento.tipo_evento.in_(TIPOS_ACCESO))
+
+        # Fechas ya validadas por el endpoint: un error acá llegaría con el 200 ya enviado (CSV truncado)
+        if desde: q = q.filter(Evento.ts >= desde)
+        if hasta: q = q.filter(Evento.ts < hasta + timedelta(days=1))
+        if sensor_id and sensor_id != "todos": q = q.filter(Evento.id_sensor == sensor_id)
+        if username and username != "todos": q = q.filter(Evento.username == username)
+
+        writer = csv.writer(_EcoCSV())
+        yield writer.writerow(["Fecha", "Tipo", "Origen", "Detalle"])
+        # yield_per => cursor del lado del servidor (stream_results): memoria acotada sea cual sea el tamaño
+        tanda = []
+        for r in q.order_by(Evento.ts.desc()).yield_per(filas_por_tanda):
+            tanda.append(writer.writerow([r.ts.strftime("%Y-%m-%d %H:%M:%S"), r.tipo_evento, r.id_sensor or r.username or "Sistema", r.detalle]))
+            if len(tanda) >= filas_por_tanda:
+                yield "".join(tanda); tanda = []
+        if tanda: yield "".join(tanda)
+    finally:
+        db.close()
+
+# --- EXPORTACIÓN MASIVA DE LECTURAS (Parquet / Arrow IPC / CSV) ---
+class _SumideroBytes(io.RawIOBase):
+    # Destino de escritura de pyarrow que acumula lo escrito hasta que el generador lo entrega
+    def __init__(self):
+        self.partes = []
+        self.posicion = 0
+    def writable(self): return True
+    def tell(self): return self.posicion
+    def write(self, b):
+        self.partes.append(bytes(b)); self.posicion += len(b)
+        return len(b)
+    def vaciar(self):
+        datos = b"".join(self.partes); self.partes = []
+        return datos
+
+def generar_export_lecturas(formato: str, ids_sensores: Optional[List[str]], areas: Optional[List[str]], desde: datetime.datetime, hasta: datetime.datetime):
+    db = SessionLocal()
+    try:
+        stmt = select(Lectura.ts, Lectura.id_sensor, Lectura.valor).where(Lectura.ts >= desde, Lectura.ts < hasta)
+        if ids_sensores: stmt = stmt.where(Lectura.id_sensor.in_(ids_sensores))
+        if areas is not None:
+            stmt = stmt.where(Lectura.id_sensor.in_(select(Sensor.id).join(Nodo).where(Nodo.area.in_(areas))))
+        # Cursor del lado del servidor, leído por tandas: nunca está el resultado completo en memoria
+        tandas = db.execute(stmt.order_by(Lectura.ts.asc()).execution_options(yield_per=EXPORT_FILAS_POR_TANDA)).partitions()
+
+        if formato == "csv":
+            writer = csv.writer(_EcoCSV())
+            yield writer.writerow(["ts", "id_sensor", "valor"])
+            for filas in tandas:
+                yield "".join(writer.writerow([r[0].isoformat(), r[1], r[2]]) for r in filas)
+            return
+
+        import pyarrow as pa
+        esquema = pa.schema([("ts", pa.timestamp("us", tz="UTC")), ("id_sensor", pa.string()), ("valor", pa.float64())])
+        sumidero = _SumideroBytes()
+        if formato == "parquet":
+            import pyarrow.parquet as pq
+            escritor = pq.ParquetWriter(sumidero, esquema, compression="zstd")
+        else:
+            escritor = pa.ipc.new_stream(sumidero, esquema)
+        for filas in tandas:
+            ts, ids, valores = zip(*filas)
+            escritor.write_batch(pa.record_batch([pa.array(ts, esquema.field("ts").type), pa.array(ids, pa.string()), pa.array(valores, pa.float64())], schema=esquema))
+            yield sumidero.vaciar()
+        escritor.close()
+        yield sumidero.vaciar()
+    finally:
+        db.close()
+
+FORMATOS_EXPORT = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows")
+}
+
+# OJO: debe registrarse antes que /api/exportar/{tipo_log}
+@app.get("/api/exportar/lecturas")
+def exportar_lecturas(
+    u: Annotated[User, Depends(get_current_tecnico_user)],
+    formato: str = Query("parquet", pattern="^(csv|parquet|arrow)$"),
+    sensores: Optional[str] = None, # Lista separada por comas
+    area: Optional[str] = None,
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None
+):
+    if formato != "csv":
+        try: import pyarrow
+        except ImportError: raise HTTPException(501, "Formato no disponible: falta instalar pyarrow")
+
+    hasta = hasta or datetime.datetime.now(datetime.timezone.utc)
+    if hasta.tzinfo is None: hasta = hasta.replace(tzinfo=datetime.timezone.utc)
+    desde = desde or hasta - timedelta(days=1)
+    if desde.tzinfo is None: desde = desde.replace(tzinfo=datetime.timezone.utc)
+    if desde >= hasta: raise HTTPException(400, "'desde' debe ser anterior a 'hasta'")
+
+    # Los que no son Admin solo exportan sus áreas suscriptas (igual que /api/nodos/all)
+    areas = None
+    if area and area != "todos": areas = [area]
+    if u.rol != "Admin":
+        permitidas = u.suscripciones
+        areas = [a for a in (areas or permitidas) if a in permitidas]
+        if not areas: raise HTTPException(403, "Sin áreas suscriptas para exportar")
+    ids_sensores = [x.strip() for x in sensores.split(",") if x.strip()] if sensores else None
+
+    media_type, extension = FORMATOS_EXPORT[formato]
+    return StreamingResponse(
+        generar_export_lecturas(formato, ids_sensores, areas, desde, hasta),
+        media_type=media_type, headers={"Content-Disposition": f"attachment; filename=lecturas.{extension}"}
+    )
 
 @app.get("/api/exportar/{tipo_log}")
-def exportar_csv(tipo_log: str, u: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db), desde: Optional[str] = None, hasta: Optional[str] = None, sensor_id: Optional[str] = None, username: Optional[str] = None):
+def exportar_csv(tipo_log: str, u: Annotated[User, Depends(get_current_active_user)], desde: Optional[str] = None, hasta: Optional[str] = None, sensor_id: Optional[str] = None, username: Optional[str] = None):
     if tipo_log in ["auditoria", "accesos"] and u.rol != "Admin": raise HTTPException(403)
     if tipo_log in ["alarmas", "conexiones"] and u.rol not in ["Admin", "Supervisor", "Tecnico"]: raise HTTPException(403)
-
-    q = db.query(Evento)
-    if tipo_log == "alarmas": q = q.filter(Evento.tipo_evento.in_(["ALARMA_ALTA", "ALARMA_BAJA"]))
-    elif tipo_log == "conexiones": q = q.filter(Evento.tipo_evento.in_(["DESCONECTADO", "RECONECTADO"]))
-    elif tipo_log == "auditoria": q = q.filter(Evento.tipo_evento.notin_(["LOGIN_EXITOSO", "LOGIN_FALLIDO", "ALARMA_ALTA", "ALARMA_BAJA", "DESCONECTADO", "RECONECTADO"]))
-    elif tipo_log == "accesos": q = q.filter(Evento.tipo_evento.in_(["LOGIN_EXITOSO", "LOGIN_FALLIDO"]))
-    else: raise HTTPException(400)
-
-    if desde: q = q.filter(Evento.ts >= desde)
-    if hasta: q = q.filter(Evento.ts < datetime.datetime.fromisoformat(hasta) + timedelta(days=1))
-    if sensor_id and sensor_id != "todos": q = q.filter(Evento.id_sensor == sensor_id)
-    if username and username != "todos": q = q.filter(Evento.username == username)
-    
-    resultados = q.order_by(Evento.ts.desc()).all()
-    output = io.StringIO(); writer = csv.writer(output)
-    writer.writerow(["Fecha", "Tipo", "Origen", "Detalle"])
-    for r in resultados: writer.writerow([r.ts.strftime("%Y-%m-%d %H:%M:%S"), r.tipo_evento, r.id_sensor or r.username or "Sistema", r.detalle])
-    output.seek(0)
-    return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={"Content-Disposition": f"attachment; filename=reporte_{tipo_log}.csv"})
+    if tipo_log not in ["alarmas", "conexiones", "auditoria", "accesos"]: raise HTTPException(400)
+    # Se validan antes de responder: dentro del generador los headers 200 ya salieron
+    fechas = {}
+    for nombre, valor in (("desde", desde), ("hasta", hasta)):
+        if not valor: continue
+        try: fechas[nombre] = datetime.datetime.fromisoformat(valor)
+        except ValueError: raise HTTPException(400, f"Fecha '{nombre}' inválida")
+
+    return StreamingResponse(
+        generar_csv_eventos(tipo_log, fechas.get("desde"), fechas.get("hasta"), sensor_id, username),
+        media_type="text/csv", headers={"Content-Disposition": f"attachment; filename=reporte_{tipo_log}.csv"}
+    )
 
 @app.post("/api/usuarios/cambiar-password-propio")
 def cambiar_password_propio(r: PasswordChangeRequest, u: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db)):
@@ -835,6 +2724,7 @@ def cambiar_password_propio(r: PasswordChangeRequest, u: Annotated[User, Depends
     db_user.force_password_change = False
     db.add(Evento(tipo_evento="CAMBIO_PASSWORD", username=u.username, detalle="Usuario cambió su propia contraseña"))
     db.commit()
+    cache_principales.invalidar(u.username)
     return {"status": "ok", "message": "Contraseña actualizada exitosamente."}
 
 # [backend/main.py] - Agregar antes de @app.post("/api/lectura")
@@ -879,36 +2769,51 @@ def replace_node(req: NodeReplaceRequest, u: Annotated[User, Depends(get_current
     db.add(Evento(tipo_evento="REEMPLAZO_NODO", username=u.username, detalle=f"Nodo {req.id_viejo} reemplazado por {req.id_nuevo}"))
     
     db.commit()
+    # Cambian varios sensores y dos nodos: operación rara, recargamos el registro completo
+    registro.cargar(db)
     return {"status": "ok", "message": "Reemplazo exitoso. El historial se ha conservado."}
-# [backend/main.py] Reemplazar función ingest
-
-@app.post("/api/lectura")
-async def ingest(
-    l: LecturaRequest, 
-    bg: BackgroundTasks, 
-    k: str = Depends(get_api_key), 
-    db: Session = Depends(get_db)
-):
-    # 1. AUTO-DESCUBRIMIENTO DE NODO
-    nodo = db.query(Nodo).filter(Nodo.id == l.id_nodo).first()
-    if not nodo:
+# --- PIPELINE DE INGESTA (compartido por /api/lectura y /api/lectura/batch) ---
+def procesar_lecturas(db: Session, lecturas: List[LecturaRequest]):
+    """
+    Procesa un lote de lecturas (de uno o varios nodos) dentro de la transacción de `db`:
+    auto-descubre nodos/sensores, actualiza baterías y registra los eventos de alarma. NO hace commit
+    ni modifica el estado en memoria (registro, motor de alarmas, vigilante): eso lo hace
+    aplicar_cambios() cuando el commit salió bien, así un lote fallido no pisa a los concurrentes.
+    Los metadatos salen del registro en memoria: solo se consulta la BD por ids desconocidos.
+    Devuelve (alarmas, filas, cambios): alarmas = [(sensor, tipo, mensaje), ...], las filas de
+    `lecturas` listas para un único INSERT multi-fila y los cambios en memoria pendientes.
+    """
+    cambios = {"nodos": {}, "sensores": {}, "alarmas": {}, "vistos": [], "ts": None}
+    nodo_de = lambda nid: cambios["nodos"].get(nid) or registro.nodo(nid)
+    sensor_de = lambda sid: cambios["sensores"].get(sid) or registro.sensor(sid)
+    # 1. Ids que el registro no conoce (pueden existir igual, p.ej. creados por otro worker; ya están en la BD)
+    faltan_nodos = {l.id_nodo for l in lecturas if registro.nodo(l.id_nodo) is None}
+    faltan_sensores = {l.id_sensor for l in lecturas if registro.sensor(l.id_sensor) is None}
+    if faltan_nodos:
+        for n in db.query(Nodo).filter(Nodo.id.in_(faltan_nodos)).all(): registro.guardar_nodo(n)
+    if faltan_sensores:
+        for s in db.query(Sensor).filter(Sensor.id.in_(faltan_sensores)).all(): registro.guardar_sensor(s)
+
+    # 2. AUTO-DESCUBRIMIENTO DE NODOS
+    nuevos_nodos = {}
+    for l in lecturas:
+        if nodo_de(l.id_nodo) is not None or l.id_nodo in nuevos_nodos: continue
         # Si no existe, lo creamos en estado "Pendiente"
         nodo = Nodo(
-            id=l.id_nodo, 
+            id=l.id_nodo,
             area="Pendiente", # Marca para que el frontend sepa que es nuevo
-            direccion="Sin asignar", 
-            piso="-", 
+            direccion="Sin asignar",
+            piso="-",
             bateria=l.bateria_nodo or 100
         )
         db.add(nodo)
         db.add(Evento(tipo_evento="NODO_DETECTADO", username="Sistema", detalle=f"Nuevo hardware detectado: {l.id_nodo}"))
-        db.commit() # Guardar para que el sensor pueda referenciarlo
-        db.refresh(nodo)
+        nuevos_nodos[l.id_nodo] = nodo
 
-    # 2. AUTO-DESCUBRIMIENTO DE SENSOR
-    sensor = db.query(Sensor).filter(Sensor.id == l.id_sensor).first()
-    if not sensor:
-        # Si no existe, lo creamos DESHABILITADO
+    # 3. AUTO-DESCUBRIMIENTO DE SENSORES (los creamos DESHABILITADOS)
+    nuevos_sensores = {}
+    for l in lecturas:
+        if sensor_de(l.id_sensor) is not None or l.id_sensor in nuevos_sensores: continue
         sensor = Sensor(
             id=l.id_sensor,
             id_nodo=l.id_nodo,
@@ -921,56 +2826,199 @@ async def ingest(
         )
         db.add(sensor)
         db.add(Evento(tipo_evento="SENSOR_DETECTADO", username="Sistema", detalle=f"Nuevo sensor {l.id_sensor} en {l.id_nodo}"))
+        nuevos_sensores[l.id_sensor] = sensor
+    if nuevos_nodos or nuevos_sensores:
+        db.flush() # Nodos y sensores nuevos deben existir antes de insertar lecturas (FK)
+        for n in nuevos_nodos.values(): cambios["nodos"][n.id] = NodoMeta.model_validate(n)
+        for s in nuevos_sensores.values(): cambios["sensores"][s.id] = SensorMeta.model_validate(s)
+
+    # 4. Baterías: solo escribimos si el valor cambió respecto del registro
+    baterias = {l.id_nodo: l.bateria_nodo for l in lecturas if l.bateria_nodo is not None}
+    for nid, bateria in baterias.items():
+        nodo = nodo_de(nid)
+        if nodo.bateria != bateria:
+            db.query(Nodo).filter(Nodo.id == nid).update({"bateria": bateria}, synchronize_session=False)
+            cambios["nodos"][nid] = nodo.model_copy(update={"bateria": bateria})
+
+    # 5. Lecturas y alarmas (solo las transiciones del motor generan evento)
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    cambios["ts"] = ahora
+    filas = []
+    alarmas = []
+    con_transicion = set()
+    reconectados = set()
+    for l in lecturas:
+        filas.append({"ts": ahora, "id_sensor": l.id_sensor, "valor": l.valor})
+        sensor = sensor_de(l.id_sensor)
+        cambios["vistos"].append(l.id_sensor)
+        previo = vigilante_conexiones.desconectado_desde(l.id_sensor)
+        if previo is not None and l.id_sensor not in reconectados:
+            reconectados.add(l.id_sensor)
+            ausencia = int(ahora.timestamp() - previo)
+            db.add(Evento(tipo_evento="RECONECTADO", id_sensor=l.id_sensor, detalle=f"Volvió a reportar tras {ausencia}s sin datos"))
+        transicion = motor_alarmas.evaluar(sensor, l.valor, ahora, cambios["alarmas"])
+        if transicion:
+            tipo, msg = transicion
+            db.add(Evento(tipo_evento=tipo, id_sensor=l.id_sensor, detalle=msg))
+            alarmas.append((sensor, tipo, msg))
+            con_transicion.add(l.id_sensor)
+    motor_alarmas.checkpoint(db, cambios["alarmas"], con_transicion)
+    return alarmas, filas, cambios
+
+def aplicar_cambios(cambios: dict):
+    # Estado en memoria de un lote ya confirmado (síncrono: ningún otro lote se intercala)
+    registro.aplicar(cambios["nodos"], cambios["sensores"])
+    motor_alarmas.aplicar(cambios["alarmas"])
+    for sid in cambios["vistos"]: vigilante_conexiones.visto(sid, cambios["ts"])
+
+def guardar_lecturas(db: Session, lecturas: List[LecturaRequest]):
+    # Procesa y confirma el lote en una transacción. El estado en memoria se actualiza solo si el
+    # commit salió bien; si falla, alcanza con el rollback de este lote (los concurrentes no se tocan).
+    # En modo INGESTA_ASINCRONA las lecturas van al buffer y las escribe el escritor en grupo.
+    if INGESTA_ASINCRONA: buffer_lecturas.reservar(len(lecturas))
+    try:
+        alarmas, filas, cambios = procesar_lecturas(db, lecturas)
+        if not INGESTA_ASINCRONA and filas:
+            db.execute(insert(Lectura), filas) # Un solo INSERT para todo el lote
+            upsert_ultimas(db, filas)
+            upsert_rollups(db, filas)
         db.commit()
-        db.refresh(sensor)
+    except Exception:
+        if INGESTA_ASINCRONA: buffer_lecturas.liberar(len(lecturas))
+        db.rollback()
+        raise
+    aplicar_cambios(cambios)
+    if INGESTA_ASINCRONA: buffer_lecturas.encolar(filas, len(lecturas))
+    actualizar_espejo_ultimas(filas)
+    contar_ingesta(lecturas, alarmas)
+    return alarmas
+
+# Altas de nodos/sensores: dos lotes concurrentes no deben insertar el mismo id
+lock_descubrimiento = asyncio.Lock()
+
+async def guardar_lecturas_async(db: AsyncSession, lecturas: List[LecturaRequest]):
+    # Mismo pipeline sobre la conexión asyncpg: el código sync corre con run_sync y cada round trip
+    # cede el event loop, así la ingesta concurrente solapa su I/O en vez de serializarla.
+    # Solo si hay ids que el registro no conoce se toma el lock (en régimen normal no se toma).
+    if any(registro.nodo(l.id_nodo) is None or registro.sensor(l.id_sensor) is None for l in lecturas):
+        async with lock_descubrimiento: return await db.run_sync(guardar_lecturas, lecturas)
+    return await db.run_sync(guardar_lecturas, lecturas)
+
+async def notificar_lecturas(db: AsyncSession, lecturas: List[LecturaRequest], alarmas: list):
+    # Notificar al dashboard (incluso si no está configurado, para ver que "está vivo").
+    # Se acumula en el difusor: sale en el próximo frame de cada sala.
+    for l in lecturas:
+        if l.bateria_nodo is None: difusor_salas.publicar(l.id_sensor, valor=l.valor, conectado=True)
+        else: difusor_salas.publicar(l.id_sensor, valor=l.valor, bateria=l.bateria_nodo, conectado=True)
+
+    # Enviar email solo si es visible y hay alarma (destinatarios se leen una vez por lote)
+    if not alarmas: return
+    if not cache_config.valores.get("smtp_host"): return
+    filas = await db.execute(select(Usuario.email).where(Usuario.rol.in_(["Admin", "Supervisor"]), Usuario.activo == True))
+    emails = [e for e in filas.scalars() if e and "@" in e]
+    if not emails: return
+    for sensor, tipo, msg in alarmas:
+        icono, asunto = ("✅", "Normalizado") if tipo == "ALARMA_NORMALIZADA" else ("⚠️", "Alerta")
+        html = f"<h2>{icono} {tipo}</h2><p>Sensor: {sensor.nombre_tarjeta}</p><p>{msg}</p>"
+        despachador_emails.encolar_alerta(emails, f"{asunto}: {sensor.nombre_tarjeta}", html)
+
+def validar_lote(items: list, modelo):
+    # Valida cada ítem por separado: un ítem malo no tumba al resto del lote
+    resultados = []
+    validos = []
+    for i, item in enumerate(items):
+        try:
+            validos.append(modelo(**item))
+            resultados.append({"indice": i, "status": "ok"})
+        except (ValidationError, TypeError) as e:
+            resultados.append({"indice": i, "status": "error", "detalle": str(e)})
+    return validos, resultados
+
+def dato_a_lectura(d: DatoSensor) -> LecturaRequest:
+    return LecturaRequest(id_nodo=d.id_nodo, id_sensor=d.id_sensor, valor=d.valor)
+
+async def ingerir_telemetria(db: AsyncSession, items: list):
+    """Frames del firmware (DatoSensor) -> mismo pipeline que /api/lectura/batch."""
+    datos, resultados = validar_lote(items, DatoSensor)
+    lecturas = [dato_a_lectura(d) for d in datos]
+    alarmas = []
+    if lecturas:
+        alarmas = await guardar_lecturas_async(db, lecturas)
+        await notificar_lecturas(db, lecturas, alarmas)
+    return {"recibidas": len(items), "guardadas": len(lecturas), "alarmas": len(alarmas), "resultados": resultados}
 
-    # 3. Actualizar batería si cambió
-    if l.bateria_nodo is not None:
-        nodo.bateria = l.bateria_nodo
+@app.post("/api/lectura")
+async def ingest(
+    l: LecturaRequest, 
+    response: Response,
+    k: str = Depends(get_api_key), 
+    db: AsyncSession = Depends(get_async_db)
+):
+    alarmas = await guardar_lecturas_async(db, [l])
+    await notificar_lecturas(db, [l], alarmas)
+    if INGESTA_ASINCRONA:
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"status":"encolada"}
+    return {"status":"ok"}
 
-    # 4. Guardar Lectura
-    db.add(Lectura(id_sensor=l.id_sensor, valor=l.valor))
-    
-    # 5. Lógica de Alarmas (Solo si el sensor es visible/configurado)
-    alarma_activa = False
-    tipo = ""
-    msg = ""
-    
-    # Solo evaluamos alarmas si tiene límites configurados
-    if sensor.visible and sensor.limite_alto is not None and l.valor > sensor.limite_alto:
-         alarma_activa = True; tipo = "ALARMA_ALTA"; msg = f"Valor {l.valor}{sensor.unidad or ''} > {sensor.limite_alto}"
-         db.add(Evento(tipo_evento=tipo, id_sensor=l.id_sensor, detalle=msg))
-    elif sensor.visible and sensor.limite_bajo is not None and l.valor < sensor.limite_bajo:
-         alarma_activa = True; tipo = "ALARMA_BAJA"; msg = f"Valor {l.valor}{sensor.unidad or ''} < {sensor.limite_bajo}"
-         db.add(Evento(tipo_evento=tipo, id_sensor=l.id_sensor, detalle=msg))
+@app.post("/api/lectura/batch")
+async def ingest_batch(
+    response: Response,
+    items: List[dict] = Body(...),
+    k: str = Depends(get_api_key),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if len(items) > MAX_LOTE_LECTURAS:
+        raise HTTPException(413, f"Máximo {MAX_LOTE_LECTURAS} lecturas por lote")
 
-    db.commit()
-    
-    # Notificar al dashboard (incluso si no está configurado, para ver que "está vivo")
-    await sio.emit('nueva_lectura', {"id": l.id_sensor, "valor": l.valor, "bateria": l.bateria_nodo, "conectado": True})
-
-    # Enviar email solo si es visible y hay alarma
-    if alarma_activa:
-        configs = db.query(Configuracion).all()
-        conf_dict = {c.id: c.valor for c in configs}
-        if conf_dict.get("smtp_host"):
-            users = db.query(Usuario).filter(Usuario.rol.in_(["Admin", "Supervisor"]), Usuario.activo == True).all()
-            emails = [u.email for u in users if u.email and "@" in u.email]
-            if emails:
-                html = f"<h2>⚠️ {tipo}</h2><p>Sensor: {sensor.nombre_tarjeta}</p><p>{msg}</p>"
-                bg.add_task(enviar_email_alerta, conf_dict, emails, f"Alerta: {sensor.nombre_tarjeta}", html)
+    # 1. Validar cada ítem por separado
+    validas, resultados = validar_lote(items, LecturaRequest)
 
-    return {"status":"ok"}
+    # 2. Todas las lecturas válidas en una sola transacción
+    alarmas = []
+    if validas:
+        try:
+            alarmas = await guardar_lecturas_async(db, validas)
+        except HTTPException: raise
+        except Exception as e:
+            print(f"❌ Error guardando lote de lecturas: {e}")
+            raise HTTPException(500, f"Error guardando lote: {e}")
+        await notificar_lecturas(db, validas, alarmas)
+
+    if INGESTA_ASINCRONA: response.status_code = status.HTTP_202_ACCEPTED
+    return {
+        "status": "encolada" if INGESTA_ASINCRONA else "ok",
+        "recibidas": len(items),
+        "guardadas": len(validas),
+        "alarmas": len(alarmas),
+        "resultados": resultados
+    }
+
+@app.get("/api/ingesta/estado")
+def estado_ingesta(u: Annotated[User, Depends(get_current_admin_user)]):
+    return {"modo": "asincrono" if INGESTA_ASINCRONA else "sincrono", "buffer": buffer_lecturas.estado(), "conexiones": vigilante_conexiones.estado(), "difusion": difusor_salas.estado(), "captura": captura_ingesta.estado()}
+
+@app.get("/api/perfil/sql")
+def perfil_sql(u: Annotated[User, Depends(get_current_admin_user)], limite: int = Query(50, ge=1, le=1000)):
+    if not PERFIL_SQL: raise HTTPException(404, "Perfil SQL desactivado (PERFIL_SQL=true para activarlo)")
+    return {"rutas": analizar_rutas(), "requests": list(historial_perfiles)[-limite:][::-1]}
+
+@app.get("/api/seguridad/estado")
+def estado_seguridad(u: Annotated[User, Depends(get_current_admin_user)]):
+    return {"bcrypt": pool_contrasenas.estado(), "principales": cache_principales.estado()}
+
+@app.get("/api/notificaciones/estado")
+def estado_notificaciones(u: Annotated[User, Depends(get_current_admin_user)]):
+    return despachador_emails.estado()
 
 @app.post("/api/password-recovery/request")
 async def request_password_recovery(
     r: RecoveryRequest, 
-    background_tasks: BackgroundTasks, 
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 1. Buscar usuario por email
-    user = db.query(Usuario).filter(Usuario.email == r.email).first()
+    user = (await db.execute(select(Usuario).where(Usuario.email == r.email))).scalars().first()
     
     # Por seguridad, si no existe no damos error 404, pero tampoco enviamos nada.
     # (Opcional: puedes lanzar 404 si prefieres usabilidad sobre seguridad estricta)
@@ -986,11 +3034,8 @@ async def request_password_recovery(
     base_url = str(request.base_url).rstrip("/")
     link = f"{base_url}/web/recover-password.html?token={token}"
     
-    # 4. Enviar Email
-    configs = db.query(Configuracion).all()
-    conf_dict = {c.id: c.valor for c in configs}
-    
-    if conf_dict.get("smtp_host"):
+    # 4. Enviar Email (por el despachador: no ocupa al worker del request)
+    if cache_config.valores.get("smtp_host"):
         html = f"""
         <div style="font-family: Arial; padding: 20px; border: 1px solid #ccc; border-radius: 8px;">
             <h2 style="color: #0056b3;">Recuperación de Contraseña</h2>
@@ -1002,7 +3047,7 @@ async def request_password_recovery(
             <p><small>Si no solicitaste esto, ignora este correo.</small></p>
         </div>
         """
-        background_tasks.add_task(enviar_email_alerta, conf_dict, [user.email], "Restablecer Contraseña - HI SENS", html)
+        despachador_emails.encolar([user.email], "Restablecer Contraseña - HI SENS", html)
     
     return {"message": "Si el email existe, se enviaron las instrucciones."}
 
@@ -1032,6 +3077,7 @@ def reset_password_with_token(r: RecoveryReset, db: Session = Depends(get_db)):
     
     db.add(Evento(tipo_evento="RESET_PASSWORD", username=user.username, detalle="Recuperación por email exitosa"))
     db.commit()
+    cache_principales.invalidar(user.username)
     
     return {"message": "Contraseña actualizada correctamente."}
 
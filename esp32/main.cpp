@@ -12,6 +12,9 @@ const char *password = "Italiano";
 const char *serverUrl =
     "https://hi-sens-t-production.up.railway.app/api/telemetria";
 
+// --- CLAVE DE LOS NODOS (debe coincidir con API_KEY_SECRET del backend) ---
+const char *apiKey = "una-clave-secreta-larga-para-los-nodos-12345";
+
 // --- VARIABLES ---
 float tempC = 25.5; // Simuladas
 float voltaje = 220.0;
@@ -41,6 +44,7 @@ void enviarDatosHTTP() {
     // 2. Iniciar conexión
     if (http.begin(client, serverUrl)) {
       http.addHeader("Content-Type", "application/json");
+      http.addHeader("X-API-Key", apiKey);
 
       // 3. Crear JSON
       DynamicJsonDocument doc(1024);
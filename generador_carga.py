@@ -0,0 +1,255 @@
+"""
+Generador de carga para el backend HI-SENS.
+
+Simula N nodos ESP32 x M sensores contra un servidor (local o de pruebas) y mide
+throughput, latencia (p50/p95/p99) y errores. A diferencia de `simulador_esp32.py`
+todo es asíncrono: miles de nodos comparten un pool de conexiones HTTP.
+
+Modos:
+  lectura     -> un POST /api/lectura por sensor (como simulador_esp32.py)
+  telemetria  -> un POST /api/telemetria por nodo con todos sus sensores (como el firmware)
+  socket      -> un Socket.IO 'dato_sensor' por nodo (una conexión por nodo)
+  mixto       -> cada nodo elige uno de los tres al azar al arrancar
+
+Ejemplos:
+  python generador_carga.py --nodos 500 --sensores 4 --intervalo 10 --duracion 120
+  python generador_carga.py --modo socket --nodos 200 --rampa lineal:60 --fuera-rango 0.02
+  python generador_carga.py --preparar --admin-pass Admin1234 --nodos 50 --salida resultado.json
+
+Requiere: pip install aiohttp "python-socketio[asyncio_client]"
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+API_KEY = "una-clave-secreta-larga-para-los-nodos-12345" # Debe coincidir con backend/main.py
+
+
+# --- MÉTRICAS ---
+class Resultados:
+    def __init__(self):
+        self.latencias = []       # segundos, solo envíos OK
+        self.lecturas_ok = 0
+        self.envios_ok = 0
+        self.errores = {}         # motivo -> cantidad
+        self.atrasos = 0          # ciclos que arrancaron tarde (el cliente no dio abasto)
+        self.inicio = time.perf_counter()
+        self.ventana = []         # latencias desde el último reporte de progreso
+
+    def ok(self, latencia: float, lecturas: int):
+        self.latencias.append(latencia)
+        self.ventana.append(latencia)
+        self.envios_ok += 1
+        self.lecturas_ok += lecturas
+
+    def error(self, motivo: str):
+        self.errores[motivo] = self.errores.get(motivo, 0) + 1
+
+
+def percentil(valores: list, p: float):
+    if not valores: return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def resumen(r: Resultados, args):
+    duracion = time.perf_counter() - r.inicio
+    total_errores = sum(r.errores.values())
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        "modo": args.modo,
+        "nodos": args.nodos,
+        "sensores_por_nodo": args.sensores,
+        "intervalo_seg": args.intervalo,
+        "rampa": args.rampa,
+        "duracion_seg": round(duracion, 1),
+        "objetivo_lecturas_seg": round(args.nodos * args.sensores / args.intervalo, 1),
+        "lecturas_seg": round(r.lecturas_ok / duracion, 1) if duracion else 0,
+        "envios_seg": round(r.envios_ok / duracion, 1) if duracion else 0,
+        "lecturas_ok": r.lecturas_ok,
+        "envios_ok": r.envios_ok,
+        "errores": total_errores,
+        "tasa_error": round(total_errores / (r.envios_ok + total_errores), 4) if r.envios_ok + total_errores else 0,
+        "errores_por_motivo": r.errores,
+        "ciclos_atrasados": r.atrasos,
+        "latencia_ms": {
+            "p50": ms(percentil(r.latencias, 50)),
+            "p95": ms(percentil(r.latencias, 95)),
+            "p99": ms(percentil(r.latencias, 99)),
+            "max": ms(max(r.latencias)) if r.latencias else None
+        }
+    }
+
+
+# --- RAMPA: cuándo arranca cada nodo ---
+def inicio_nodo(i: int, args):
+    tipo, _, param = args.rampa.partition(":")
+    if tipo == "lineal":
+        # Todos los nodos arrancan repartidos a lo largo de `param` segundos
+        return float(param or 60) * i / args.nodos
+    if tipo == "escalones":
+        # "escalones:4x30" -> 4 tandas de nodos, una cada 30 segundos
+        pasos, _, cada = (param or "4x30").partition("x")
+        return (i * int(pasos) // args.nodos) * float(cada)
+    # constante: todos desde el principio, desfasados dentro del primer intervalo
+    return random.uniform(0, args.intervalo)
+
+
+# --- DATOS SIMULADOS ---
+def valor_sensor(args):
+    # Temperatura ambiente; de vez en cuando un valor fuera de rango para disparar alarmas
+    if random.random() < args.fuera_rango: return round(random.choice([random.uniform(60, 90), random.uniform(-30, -10)]), 2)
+    return round(random.uniform(20.0, 25.0), 2)
+
+
+def ids_nodo(i: int, args):
+    id_nodo = f"{args.prefijo}-{i:04d}"
+    return id_nodo, [f"{id_nodo}-S{j:02d}" for j in range(args.sensores)]
+
+
+# --- ENVÍOS ---
+async def enviar_http(sesion: aiohttp.ClientSession, r: Resultados, url: str, cuerpo, lecturas: int):
+    inicio = time.perf_counter()
+    try:
+        async with sesion.post(url, json=cuerpo) as resp:
+            await resp.read()
+            if resp.status < 300: r.ok(time.perf_counter() - inicio, lecturas)
+            else: r.error(f"HTTP {resp.status}")
+    except asyncio.TimeoutError:
+        r.error("timeout")
+    except aiohttp.ClientError as e:
+        r.error(type(e).__name__)
+
+
+async def nodo(i: int, sesion: aiohttp.ClientSession, r: Resultados, args, fin: float):
+    id_nodo, sensores = ids_nodo(i, args)
+    modo = random.choice(["lectura", "telemetria", "socket"]) if args.modo == "mixto" else args.modo
+    await asyncio.sleep(inicio_nodo(i, args))
+
+    cliente = None
+    if modo == "socket":
+        import socketio
+        cliente = socketio.AsyncClient(reconnection=True)
+        try: await cliente.connect(args.url, auth={"api_key": args.api_key}, transports=["websocket"], wait_timeout=args.timeout)
+        except Exception as e:
+            r.error(f"socket connect: {type(e).__name__}")
+            return
+
+    bateria = random.randint(60, 100)
+    proximo = time.perf_counter()
+    try:
+        while proximo < fin:
+            if modo == "lectura":
+                # Un POST por sensor, en paralelo (comparten el pool de conexiones)
+                await asyncio.gather(*[
+                    enviar_http(sesion, r, f"{args.url}/api/lectura", {"id_nodo": id_nodo, "id_sensor": s, "valor": valor_sensor(args), "bateria_nodo": bateria}, 1)
+                    for s in sensores
+                ])
+            elif modo == "telemetria":
+                frame = [{"id_nodo": id_nodo, "id_sensor": s, "valor": valor_sensor(args), "tipo": "TEMPERATURA", "ubicacion": "Carga"} for s in sensores]
+                await enviar_http(sesion, r, f"{args.url}/api/telemetria", frame, len(frame))
+            else:
+                frame = [{"id_nodo": id_nodo, "id_sensor": s, "valor": valor_sensor(args), "tipo": "TEMPERATURA", "ubicacion": "Carga"} for s in sensores]
+                inicio = time.perf_counter()
+                try:
+                    # call() espera el ack: el servidor lo manda cuando terminó de procesar el frame
+                    await cliente.call("dato_sensor", frame, timeout=args.timeout)
+                    r.ok(time.perf_counter() - inicio, len(frame))
+                except socketio.exceptions.TimeoutError: r.error("socket timeout")
+                except Exception as e: r.error(f"socket: {type(e).__name__}")
+
+            # Agenda fija (no se acumula deriva); si vamos tarde no hacemos ráfaga para recuperar
+            proximo += args.intervalo
+            espera = proximo - time.perf_counter()
+            if espera < 0:
+                r.atrasos += 1
+                proximo = time.perf_counter()
+            else:
+                await asyncio.sleep(espera)
+    finally:
+        if cliente: await cliente.disconnect()
+
+
+# --- PREPARACIÓN: nodos y sensores visibles (con límites) para que haya alarmas ---
+async def preparar(sesion: aiohttp.ClientSession, args):
+    async with sesion.post(f"{args.url}/api/token", data={"username": args.admin_user, "password": args.admin_pass}) as resp:
+        if resp.status != 200:
+            print(f"❌ Login de admin falló ({resp.status}): {await resp.text()}")
+            return False
+        token = (await resp.json())["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    limite = asyncio.Semaphore(20)
+
+    async def crear(url: str, cuerpo: dict):
+        async with limite:
+            async with sesion.post(url, json=cuerpo, headers=headers) as resp:
+                if resp.status not in (200, 400): print(f"⚠️ {url}: {resp.status}") # 400 = ya existía
+
+    for i in range(args.nodos):
+        id_nodo, _ = ids_nodo(i, args)
+        await crear(f"{args.url}/api/nodos/crear", {"id": id_nodo, "area": args.area, "direccion": "Generador de carga", "piso": "-"})
+    await asyncio.gather(*[
+        crear(f"{args.url}/api/sensores/crear", {"id": s, "id_nodo": id_nodo, "nombre_tarjeta": s, "tipo": "Temperatura", "unidad": "°C"})
+        for i in range(args.nodos) for id_nodo, sensores in [ids_nodo(i, args)] for s in sensores
+    ])
+    print(f"🧰 Preparados {args.nodos} nodos x {args.sensores} sensores en el área '{args.area}'.")
+    return True
+
+
+async def progreso(r: Resultados, fin: float):
+    previo = 0
+    while time.perf_counter() < fin:
+        await asyncio.sleep(5)
+        ventana, r.ventana = r.ventana, []
+        p95 = percentil(ventana, 95)
+        print(
+            f"⏱️ {time.perf_counter() - r.inicio:6.0f}s | {(r.lecturas_ok - previo) / 5:8.1f} lecturas/s | "
+            f"p95 {p95 * 1000 if p95 is not None else 0:7.1f} ms | errores {sum(r.errores.values())}"
+        )
+        previo = r.lecturas_ok
+
+
+async def main(args):
+    headers = {"X-API-Key": args.api_key}
+    conector = aiohttp.TCPConnector(limit=args.conexiones, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout, headers=headers) as sesion:
+        if args.preparar and not await preparar(sesion, args): return
+        print(f"🚀 {args.nodos} nodos x {args.sensores} sensores | modo {args.modo} | cada {args.intervalo}s | rampa {args.rampa} | {args.duracion}s")
+        r = Resultados()
+        fin = r.inicio + args.duracion
+        tarea_progreso = asyncio.create_task(progreso(r, fin))
+        await asyncio.gather(*[nodo(i, sesion, r, args, fin) for i in range(args.nodos)])
+        tarea_progreso.cancel()
+
+    informe = resumen(r, args)
+    print(json.dumps(informe, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f: json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultado guardado en {args.salida}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Generador de carga HI-SENS (nodos ESP32 simulados)")
+    p.add_argument("--url", default="http://localhost:8000", help="URL base del backend")
+    p.add_argument("--api-key", default=API_KEY)
+    p.add_argument("--modo", choices=["lectura", "telemetria", "socket", "mixto"], default="telemetria")
+    p.add_argument("--nodos", type=int, default=100)
+    p.add_argument("--sensores", type=int, default=4, help="Sensores por nodo")
+    p.add_argument("--intervalo", type=float, default=5.0, help="Segundos entre envíos de cada nodo")
+    p.add_argument("--duracion", type=float, default=60.0, help="Segundos de prueba (incluye la rampa)")
+    p.add_argument("--rampa", default="constante", help="constante | lineal:SEG | escalones:NxSEG")
+    p.add_argument("--fuera-rango", type=float, default=0.0, help="Probabilidad de enviar un valor fuera de rango (alarmas)")
+    p.add_argument("--conexiones", type=int, default=200, help="Conexiones HTTP máximas del pool")
+    p.add_argument("--timeout", type=float, default=30.0, help="Timeout por envío (segundos)")
+    p.add_argument("--prefijo", default="CARGA", help="Prefijo de los ids de nodo simulados")
+    p.add_argument("--preparar", action="store_true", help="Crear antes nodos y sensores visibles (requiere admin)")
+    p.add_argument("--area", default="Carga", help="Área de los nodos creados con --preparar")
+    p.add_argument("--admin-user", default="admin")
+    p.add_argument("--admin-pass", default="")
+    p.add_argument("--salida", help="Archivo JSON donde guardar el resultado")
+    asyncio.run(main(p.parse_args()))
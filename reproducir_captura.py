@@ -0,0 +1,223 @@
+"""
+Reproduce una captura de ingesta real contra un backend HI-SENS (local o de pruebas).
+
+La captura la genera el backend con CAPTURA_INGESTA=true: archivos capturas/ingesta-<pid>.jsonl
+(y sus rotaciones .1, .2, ...). Este script junta todos los archivos indicados, los ordena por
+instante de llegada y vuelve a enviar cada request respetando los intervalos originales
+(ráfagas tras cortes de Wi-Fi, nodos con muchos sensores, avalanchas de alarmas), acelerado
+por --velocidad. Con --velocidad max se envía todo lo rápido que permita --concurrencia.
+
+Ejemplos:
+  python reproducir_captura.py capturas/ingesta-*.jsonl* --velocidad 10 --salida build-nuevo.json
+  python reproducir_captura.py capturas/*.jsonl* --velocidad max --comparar build-anterior.json
+
+Los sensores de la captura tienen que existir en la BD de destino (p.ej. una copia de producción)
+o se registran por auto-descubrimiento como en la primera conexión de un nodo.
+
+Requiere: pip install aiohttp
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+API_KEY = "una-clave-secreta-larga-para-los-nodos-12345" # Debe coincidir con backend/main.py
+RUTAS = {"l": "/api/lectura", "b": "/api/lectura/batch", "t": "/api/telemetria"}
+
+
+def percentil(valores: list, p: float):
+    if not valores: return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def cargar_captura(patrones: list, desde: float = None, limite: int = None):
+    archivos = sorted({a for patron in patrones for a in (glob.glob(patron) or [patron])})
+    registros, invalidas = [], 0
+    for archivo in archivos:
+        with open(archivo, encoding="utf-8") as f:
+            for linea in f:
+                try: registros.append(json.loads(linea))
+                except ValueError: invalidas += 1 # Última línea cortada por un corte del proceso
+    registros.sort(key=lambda r: r["t"])
+    leidos = len(registros)
+    if desde is not None and registros:
+        t0 = registros[0]["t"]
+        registros = [r for r in registros if r["t"] >= t0 + desde]
+    if limite: registros = registros[:limite]
+    return archivos, registros, invalidas, leidos
+
+
+def lecturas_de(registro: dict):
+    return len(registro["b"]) if isinstance(registro["b"], list) else 1
+
+
+# --- REPRODUCCIÓN ---
+class Resultados:
+    def __init__(self):
+        self.latencias = {}       # ruta -> segundos, solo envíos OK
+        self.lecturas_ok = 0
+        self.envios_ok = 0
+        self.errores = {}         # motivo -> cantidad
+        self.distintos = 0        # status distinto al capturado (p.ej. 200 en producción y 503 acá)
+        self.atrasos = []         # segundos de retraso del cliente respecto al horario a reproducir
+
+    def error(self, motivo: str):
+        self.errores[motivo] = self.errores.get(motivo, 0) + 1
+
+
+async def enviar(sesion: aiohttp.ClientSession, r: Resultados, args, registro: dict, limite: asyncio.Semaphore):
+    ruta = RUTAS[registro["r"]]
+    cuerpo = registro["b"]
+    kwargs = {"json": cuerpo} if not isinstance(cuerpo, str) else {"data": cuerpo, "headers": {"Content-Type": "application/json"}}
+    async with limite:
+        inicio = time.perf_counter()
+        try:
+            async with sesion.post(args.url + ruta, **kwargs) as resp:
+                await resp.read()
+                codigo = resp.status
+        except asyncio.TimeoutError:
+            r.error("timeout")
+            return
+        except aiohttp.ClientError as e:
+            r.error(type(e).__name__)
+            return
+        latencia = time.perf_counter() - inicio
+    if codigo != registro.get("s"): r.distintos += 1
+    if codigo >= 400:
+        r.error(f"HTTP {codigo}")
+        return
+    r.latencias.setdefault(ruta, []).append(latencia)
+    r.envios_ok += 1
+    r.lecturas_ok += lecturas_de(registro)
+
+
+async def reproducir(registros: list, args):
+    r = Resultados()
+    velocidad = None if args.velocidad == "max" else float(args.velocidad)
+    limite = asyncio.Semaphore(args.concurrencia)
+    conector = aiohttp.TCPConnector(limit=args.concurrencia)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout, headers={"X-API-Key": args.api_key}) as sesion:
+        t0 = registros[0]["t"]
+        inicio = time.perf_counter()
+        tareas = set()
+        for i, registro in enumerate(registros):
+            if velocidad:
+                # Bucle abierto: se dispara a su hora aunque los anteriores no hayan respondido
+                objetivo = inicio + (registro["t"] - t0) / velocidad
+                espera = objetivo - time.perf_counter()
+                if espera > 0: await asyncio.sleep(espera)
+                else: r.atrasos.append(-espera)
+            else:
+                while len(tareas) >= args.concurrencia * 2: await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+            tarea = asyncio.create_task(enviar(sesion, r, args, registro, limite))
+            tareas.add(tarea)
+            tarea.add_done_callback(tareas.discard)
+            if args.progreso and i and i % args.progreso == 0:
+                print(f"  ... {i}/{len(registros)} enviados ({time.perf_counter() - inicio:.0f}s)")
+        if tareas: await asyncio.wait(tareas)
+        duracion = time.perf_counter() - inicio
+    return r, duracion
+
+
+def resumen(r: Resultados, duracion: float, registros: list, archivos: list, args):
+    todas = [l for ls in r.latencias.values() for l in ls]
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    span = registros[-1]["t"] - registros[0]["t"]
+    capturadas = [x["ms"] for x in registros if x.get("ms") is not None and x.get("s", 500) < 400]
+    try: commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception: commit = None
+    return {
+        "commit": commit,
+        "fecha": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "captura": {
+            "archivos": archivos, "requests": len(registros), "lecturas": sum(lecturas_de(x) for x in registros),
+            "duracion_original_s": round(span, 1), "p50_ms_original": percentil(capturadas, 50), "p95_ms_original": percentil(capturadas, 95)
+        },
+        "parametros": {"url": args.url, "velocidad": args.velocidad, "concurrencia": args.concurrencia},
+        "duracion_s": round(duracion, 2),
+        "envios_ok": r.envios_ok,
+        "lecturas_ok": r.lecturas_ok,
+        "envios_por_seg": round(r.envios_ok / duracion, 2) if duracion else None,
+        "lecturas_por_seg": round(r.lecturas_ok / duracion, 2) if duracion else None,
+        "latencia_ms": {"p50": ms(percentil(todas, 50)), "p95": ms(percentil(todas, 95)), "p99": ms(percentil(todas, 99)), "max": ms(max(todas) if todas else None)},
+        "por_ruta": {ruta: {"envios": len(ls), "p50": ms(percentil(ls, 50)), "p95": ms(percentil(ls, 95)), "p99": ms(percentil(ls, 99))} for ruta, ls in r.latencias.items()},
+        "errores": r.errores,
+        "status_distinto_al_capturado": r.distintos,
+        # Si el cliente se atrasa, lo medido es el límite del cliente y no el del backend
+        "atrasos_cliente": {"envios": len(r.atrasos), "max_ms": ms(max(r.atrasos) if r.atrasos else None)}
+    }
+
+
+def comparar(previo: dict, actual: dict, umbral: float):
+    print(f"\nComparación con {previo.get('commit')} ({previo.get('fecha', '')[:19]}):")
+    if previo.get("captura", {}).get("requests") != actual["captura"]["requests"] or previo.get("parametros", {}).get("velocidad") != actual["parametros"]["velocidad"]:
+        print("⚠️ La captura o la velocidad no son las mismas: la comparación es orientativa.")
+    regresiones = []
+    filas = [("envios_por_seg", previo.get("envios_por_seg"), actual["envios_por_seg"], False)]
+    for p in ["p50", "p95", "p99"]: filas.append((f"latencia {p}", previo["latencia_ms"].get(p), actual["latencia_ms"][p], True))
+    filas.append(("errores", sum(previo.get("errores", {}).values()), sum(actual["errores"].values()), True))
+    for nombre, antes, ahora, menor_es_mejor in filas:
+        if antes is None or ahora is None:
+            print(f"   {nombre:<16} {antes} -> {ahora}")
+            continue
+        cambio = (ahora - antes) / antes if antes else (0.0 if ahora == antes else float("inf"))
+        peor = cambio > umbral if menor_es_mejor else cambio < -umbral
+        mejor = cambio < -umbral if menor_es_mejor else cambio > umbral
+        if peor: regresiones.append(nombre)
+        print(f"{'❌' if peor else ('✅' if mejor else '  ')} {nombre:<16} {antes:>10} -> {ahora:>10}  ({cambio:+.1%})")
+    return regresiones
+
+
+async def main(args):
+    archivos, registros, invalidas, leidos = cargar_captura(args.captura, args.desde, args.limite)
+    if not leidos:
+        print(f"❌ La captura está vacía ({len(archivos)} archivo(s), {invalidas} líneas ilegibles).")
+        sys.exit(2)
+    if not registros:
+        print(f"❌ Ningún request de los {leidos} leídos queda después de filtrar (--desde {args.desde}, --limite {args.limite}).")
+        sys.exit(2)
+    span = registros[-1]["t"] - registros[0]["t"]
+    estimado = f"~{span / float(args.velocidad):.0f}s" if args.velocidad != "max" else "lo antes posible"
+    print(f"▶️ Reproduciendo {len(registros)} requests de {len(archivos)} archivo(s) ({span:.0f}s capturados, {estimado}) contra {args.url}")
+    if invalidas: print(f"⚠️ {invalidas} líneas ilegibles omitidas")
+
+    r, duracion = await reproducir(registros, args)
+    res = resumen(r, duracion, registros, archivos, args)
+    print(json.dumps({k: res[k] for k in ["duracion_s", "envios_ok", "envios_por_seg", "lecturas_por_seg", "latencia_ms", "errores", "atrasos_cliente"]}, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f: json.dump(res, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultado guardado en {args.salida}")
+    if args.comparar:
+        regresiones = comparar(json.load(open(args.comparar, encoding="utf-8")), res, args.umbral)
+        if regresiones:
+            print(f"❌ Regresión respecto al build anterior: {', '.join(regresiones)}")
+            sys.exit(1)
+        print("✅ Sin regresiones.")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Reproducir una captura de ingesta HI-SENS")
+    p.add_argument("captura", nargs="+", help="Archivos o patrones de la captura (ingesta-*.jsonl*)")
+    p.add_argument("--url", default="http://localhost:8000", help="URL base del backend")
+    p.add_argument("--api-key", default=API_KEY)
+    p.add_argument("--velocidad", default="1", help="1, 10, ... (multiplicador del ritmo original) o 'max'")
+    p.add_argument("--concurrencia", type=int, default=200, help="Requests en vuelo como máximo")
+    p.add_argument("--timeout", type=float, default=30.0, help="Timeout por envío (segundos)")
+    p.add_argument("--desde", type=float, help="Saltear los primeros N segundos de la captura")
+    p.add_argument("--limite", type=int, help="Reproducir solo los primeros N requests")
+    p.add_argument("--progreso", type=int, default=0, help="Mostrar avance cada N requests")
+    p.add_argument("--salida", help="Archivo JSON donde guardar el resultado")
+    p.add_argument("--comparar", help="Resultado JSON de una corrida anterior (build previo) para comparar")
+    p.add_argument("--umbral", type=float, default=0.10, help="Empeoramiento relativo tolerado (0.10 = 10%%)")
+    args = p.parse_args()
+    if args.velocidad != "max" and float(args.velocidad) <= 0: p.error("--velocidad debe ser > 0 o 'max'")
+    asyncio.run(main(args))
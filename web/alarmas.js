@@ -51,9 +51,9 @@ document.addEventListener("DOMContentLoaded", () => {
       const response = await fetchWithToken(url);
       
       if (!response.ok) throw new Error("Error al obtener datos");
-      const logs = await response.json();
+      const pagina = await response.json();
       
-      renderTablaEventos(tbody, logs);
+      renderTablaEventos(tbody, pagina.items);
 
     } catch (error) {
       console.error(error);
@@ -93,55 +93,58 @@ async function iniciarDashboard() {
 
   // Sockets (Tiempo Real)
   try {
-    const socket = io(API_URL, { auth: { token: getToken() } });
-
-    socket.on("connect", () => setSystemStatus(true));
-    socket.on("disconnect", () => setSystemStatus(false));
-    socket.on('dato_sensor', (data) => {
-      // 1. Convertimos a lista siempre
-      let lista = Array.isArray(data) ? data : [data];
-
-      console.log("⚡ Procesando datos...", lista);
-
-      lista.forEach(sensor => {
-        // Construimos el ID único que buscamos en el HTML
-        // Si el sensor es LAB-T1, buscamos "dato-LAB-T1"
-        const idElemento = `dato-${sensor.id_sensor}`;
-        const elemento = document.getElementById(idElemento);
-
-        if (elemento) {
-          // Si encontramos la tarjeta, actualizamos el valor
-          let valorTexto = sensor.valor;
-
-          // Formato bonito según el tipo
-          if (sensor.tipo === "TEMPERATURA") {
-            valorTexto = parseFloat(sensor.valor).toFixed(1) + " °C";
-          } else if (sensor.tipo === "VOLTAJE") {
-            valorTexto = parseFloat(sensor.valor).toFixed(0) + " V";
-          }
-
-          elemento.innerText = valorTexto;
-
-          // Quitamos estilos de advertencia
-          if (elemento.classList.contains("text-warning")) {
-            elemento.classList.remove("text-warning");
-            // Intentar buscar el padre card para actualizar estado
-            const card = elemento.closest(".status-card");
-            if (card) {
-              card.classList.remove("estado-aviso");
-              card.classList.add("estado-ok");
-            }
-          }
-
-          // Efecto visual (Flash)
+    // auth como función: cada reconexión manda el token vigente (no el de cuando se abrió la página)
+    const socket = io(API_URL, { auth: (cb) => cb({ token: getToken() }) });
+
+    // Posición en el stream del servidor: al reconectar se piden solo los cambios desde acá
+    let sync = { epoca: null, seq: null };
+    const avanzar = (msg) => {
+      if (msg.epoca !== sync.epoca || msg.seq > sync.seq) sync = { epoca: msg.epoca, seq: msg.seq };
+    };
+
+    const aplicarCambios = (lista, flash) => {
+      lista.forEach(cambio => {
+        const cardId = `card-${cambio.id}`;
+        if (!estadoNodos[cardId]) return;
+        const { id, ...campos } = cambio;
+        Object.assign(estadoNodos[cardId], campos);
+        actualizarTarjeta(cardId, estadoNodos[cardId]);
+
+        // Efecto visual (Flash) cuando llega un valor nuevo
+        if (flash && 'valor' in campos) {
+          const elemento = tarjetas[cardId].valorEl;
           elemento.style.transition = "color 0.2s";
           elemento.style.color = "#28a745"; // Verde
           setTimeout(() => elemento.style.color = "", 500);
-
-        } else {
-          console.warn(`⚠️ Llegó el sensor [${sensor.id_sensor}] pero no hay tarjeta con id="${idElemento}"`);
         }
       });
+    };
+
+    socket.on("connect", () => {
+      setSystemStatus(true);
+      // Delta desde el último seq visto, o snapshot completo si quedamos muy atrás (o es la primera vez)
+      socket.emit('sincronizar', sync, (resp) => {
+        if (!resp || resp.tipo === "error") return;
+        avanzar(resp);
+        aplicarCambios(resp.sensores, false);
+      });
+    });
+    socket.on("disconnect", () => setSystemStatus(false));
+    socket.on("connect_error", (err) => {
+      setSystemStatus(false);
+      // Token vencido o usuario desactivado: Socket.IO no reintenta un rechazo del servidor,
+      // así que se vuelve a iniciar sesión (igual que un 401 en fetchWithToken).
+      // Los errores de red se reintentan solos.
+      if (err && err.message === "Credenciales inválidas") {
+        console.error("Sesión vencida en el socket. Cerrando sesión.");
+        window.globalLogout();
+      }
+    });
+    // Frames agrupados: el servidor manda solo las áreas suscriptas y solo los sensores que cambiaron
+    // (valor, batería y/o conectado), un frame por sala cada ~250 ms
+    socket.on('lecturas', (frame) => {
+      avanzar(frame);
+      aplicarCambios(frame.sensores, true);
     });
   } catch (e) { console.warn("Socket error", e); }
 }
@@ -519,12 +522,10 @@ function cerrarModalGrafico() {
 // --- UTILS ---
 async function cargarConfiguracionDesdeAPI() {
   try {
-    const [cRes, eRes] = await Promise.all([
-      fetchWithToken(`${API_URL}/api/nodos/all`),
-      fetchWithToken(`${API_URL}/api/sensores/estado-actual`)
-    ]);
-    if (!cRes.ok || !eRes.ok) throw new Error("API Error");
-    return { configNodos: await cRes.json(), estadoMap: (await eRes.json()).reduce((acc, e) => { acc[e.id] = e; return acc; }, {}) };
+    // El estado en vivo (valor / conectado) llega por el snapshot de 'sincronizar' al conectar el socket
+    const cRes = await fetchWithToken(`${API_URL}/api/nodos/all`);
+    if (!cRes.ok) throw new Error("API Error");
+    return { configNodos: await cRes.json(), estadoMap: {} };
   } catch (error) { console.error(error); return null; }
 }
 
@@ -18,6 +18,7 @@ document.addEventListener("DOMContentLoaded", () => {
   const confRetConexiones = document.getElementById("conf-ret-conexiones");
   const confRetAuditoria = document.getElementById("conf-ret-auditoria");
   const confRetAccesos = document.getElementById("conf-ret-accesos");
+  const confRetLecturas = document.getElementById("conf-ret-lecturas");
   
   const smtpHost = document.getElementById("smtp-host");
   const smtpPort = document.getElementById("smtp-port");
@@ -47,6 +48,7 @@ document.addEventListener("DOMContentLoaded", () => {
       if (confRetConexiones) confRetConexiones.value = config.retencion_conexiones;
       if (confRetAuditoria) confRetAuditoria.value = config.retencion_auditoria;
       if (confRetAccesos) confRetAccesos.value = config.retencion_accesos;
+      if (confRetLecturas) confRetLecturas.value = config.retencion_lecturas;
       
       if (smtpHost) smtpHost.value = config.smtp_host || "";
       if (smtpPort) smtpPort.value = config.smtp_port || 587;
@@ -76,6 +78,7 @@ document.addEventListener("DOMContentLoaded", () => {
         retencion_conexiones: parseInt(confRetConexiones.value) || 90,
         retencion_auditoria: parseInt(confRetAuditoria.value) || 365,
         retencion_accesos: parseInt(confRetAccesos.value) || 180,
+        retencion_lecturas: parseInt(confRetLecturas.value) || 90,
         
         smtp_host: smtpHost.value,
         smtp_port: parseInt(smtpPort.value) || 587,
@@ -9,6 +9,7 @@ const fetchWithToken = window.fetchWithToken;
 const API_URL = '';
 
 let currentTab = 'alarmas';
+let nextCursor = null; // Cursor de la próxima página (paginación por keyset)
 
 document.addEventListener("DOMContentLoaded", () => {
     // Configurar fechas por defecto (Últimos 7 días)
@@ -34,7 +35,8 @@ document.addEventListener("DOMContentLoaded", () => {
     });
 
     // Listeners Botones
-    document.getElementById("btn-search").addEventListener("click", cargarRegistros);
+    document.getElementById("btn-search").addEventListener("click", () => cargarRegistros());
+    document.getElementById("btn-load-more").addEventListener("click", () => cargarRegistros(true));
     document.getElementById("btn-export").addEventListener("click", exportarCSV);
 
     // Carga inicial
@@ -65,9 +67,9 @@ function updateUIForTab() {
     }
 }
 
-async function cargarRegistros() {
+async function cargarRegistros(append = false) {
     const tbody = document.getElementById("table-body");
-    tbody.innerHTML = '<tr><td colspan="4" style="text-align:center;">Cargando datos...</td></tr>';
+    if (!append) tbody.innerHTML = '<tr><td colspan="4" style="text-align:center;">Cargando datos...</td></tr>';
 
     // Construir URL con parámetros
     const desde = document.getElementById("filter-date-from").value;
@@ -91,22 +93,26 @@ async function cargarRegistros() {
         if (extraFilter) params += `&username=${extraFilter}`;
     }
 
+    if (append && nextCursor) params += `&cursor=${encodeURIComponent(nextCursor)}`;
+
     try {
         const res = await fetchWithToken(`${API_URL}${endpoint}${params}`);
         if (!res.ok) throw new Error("Error cargando registros");
         
-        const logs = await res.json();
-        renderTable(logs);
+        const pagina = await res.json();
+        nextCursor = pagina.next_cursor;
+        document.getElementById("btn-load-more").style.display = nextCursor ? "" : "none";
+        renderTable(pagina.items, append);
     } catch (e) {
         tbody.innerHTML = `<tr><td colspan="4" style="color:red; text-align:center;">Error: ${e.message}</td></tr>`;
     }
 }
 
-function renderTable(logs) {
+function renderTable(logs, append = false) {
     const tbody = document.getElementById("table-body");
-    tbody.innerHTML = "";
+    if (!append) tbody.innerHTML = "";
 
-    if (logs.length === 0) {
+    if (logs.length === 0 && !append) {
         tbody.innerHTML = '<tr><td colspan="4" style="text-align:center;">No se encontraron registros en este rango.</td></tr>';
         return;
     }